@@ -1,10 +1,21 @@
 # -*- coding:Utf-8 -*-
 # !/usr/bin/env python
 import argparse
+import collections
+import concurrent.futures
+import gc
+import http.server
+import itertools
+import json
 import logging
 import math
+import multiprocessing
 import os
+import pickle
+import socketserver
+import sqlite3
 import sys
+import tempfile
 import time
 
 import lxml.etree
@@ -12,11 +23,44 @@ import lxml.etree
 BORNE_INF_MODIF = 1.0
 BORNE_SUP_MODIF = 10.0
 NB_ZONE_USER = 500
+# nombre de batiments sérialisés par paquet lors de l'export
+EXPORT_CHUNK_SIZE = 500
+# nombre minimal de batiments d'un export pour le paralléliser (--jobs) :
+# en dessous, la création des processus fils coûte plus qu'elle ne rapporte
+EXPORT_PARALLEL_MIN_BUILDINGS = 10000
+# rapport entre la mémoire occupée par un batiment et sa taille sérialisée,
+# utilisé pour découper le traitement avec --memory-limit
+SPILL_MEMORY_FACTOR = 5
+# taille (en degrés) des cellules de l'index du bâti actuel chargé par le
+# serveur (voir CurrentBuildings)
+INDEX_CELL_SIZE = 0.01
+# port par défaut du serveur (voir serve_main)
+SERVE_PORT = 8765
+# ordre (nombre de bits par coordonnée) des courbes utilisées par spatial_keys
+CURVE_ORDER = 16
+# fichiers résultats : status des batiments -> nom du fichier
+RESULT_FILES = {"IDENTIQUE": "unModified", "MODIFIE": "mod", "NOUVEAU": "new", "SUPPRIME": "sup"}
 
 # WGS-84 Earth equatorial radius (meters)
 EARTH_RADIUS = 6378137.0
 
 
+# Jeux de tags déjà rencontrés, partagés entre les batiments
+_TAG_SETS = {}
+
+
+def intern_tags(tags) -> tuple:
+    """Cette fonction retourne le jeu de tags partagé égal aux couples
+    (clé, valeur) passés en paramètre.
+
+    Sur une commune, quelques jeux de tags (building=yes, source=cadastre...)
+    reviennent pour la plupart des batiments : ils ne sont stockés qu'une
+    fois, sous forme de tuple non modifiable.
+    """
+    tags = tuple((sys.intern(key), sys.intern(value)) for key, value in tags)
+    return _TAG_SETS.setdefault(tags, tags)
+
+
 class Point:
     """Defines a point
 
@@ -75,8 +119,10 @@ class Building:
     - dist_mini : une valeurs de distance pour détecter la modification du batiment
     - largeur : la largeur du batiment
     - status : le status du batiment (nouveau, identique, modifié, supprimé)
-    - tableau_tag_key : le tableau d'identifiants des tags
-    - tableau_tag_value : le tableau des valeurs des tags
+    - tags : les tags du batiment, tuple de couples (clé, valeur) partagé
+        entre tous les batiments ayant les mêmes tags (voir intern_tags)
+    - tableau_tag_key : le tableau d'identifiants des tags (lecture seule)
+    - tableau_tag_value : le tableau des valeurs des tags (lecture seule)
     - pbAire : l'information si le batiment a une aire nulle
     - Aire : l'aire du batiment
     - multipolygone : yes si le batiment en est un, no sinon
@@ -107,9 +153,7 @@ class Building:
         self.min_distance = float(min_distance)
         self.width = width
         self.status = status
-        self.tag_count = tag_count
-        self.tableau_tag_key = tableau_tag_key
-        self.tableau_tag_value = tableau_tag_value
+        self.tags = intern_tags(zip(tableau_tag_key, tableau_tag_value))
         self.area_issue = "NO"
         self.area = 0.0
         self.multipolygone = "no"
@@ -215,11 +259,14 @@ class Building:
         """
         self.history = history
 
-    def export_bat(self):
+    def export_bat(self, emitted: set = None):
         """Cette méthode défini une version xml du batiment, de ses noeuds
-        et de ses éventuels tag dans le but d'être transcrit dans un fichier."""
+        et de ses éventuels tag dans le but d'être transcrit dans un fichier.
+
+        emitted est l'ensemble des identifiants (entiers) des noeuds déjà
+        écrits dans le fichier : ces noeuds ne sont pas répétés et ceux du
+        batiment y sont ajoutés."""
         export = []
-        res_export = ""
         if len(self.history) > 0:
             i_hist = 0
             way_hist = "  <way "
@@ -235,21 +282,25 @@ class Building:
         while i_node < self.node_count:
             export.append(f'    <nd ref="{self.nodes[i_node].node_id}" />')
             i_node = i_node + 1
-        for i_tag in range(self.tag_count):
-            export.append(f'    <tag k="{self.tableau_tag_key[i_tag]}" v="{self.tableau_tag_value[i_tag]}" />')
+        for key, value in self.tags:
+            export.append(f'    <tag k="{key}" v="{value}" />')
         export.append("  </way>")
         i_node = 0
         while i_node < self.node_count:
+            if emitted is not None:
+                node_key = int(self.nodes[i_node].node_id)
+                if node_key in emitted:
+                    i_node = i_node + 1
+                    continue
+                emitted.add(node_key)
             self.nodes[i_node].to_xml()
             export.append(self.nodes[i_node].print_node)
             i_node = i_node + 1
         if self.multipolygone == "yes":
             # export des chemins intérieurs
-            inner_way = ""
-            for i_inner in range(len(self.inner_ways)):
-                self.inner_ways[i_inner].export_bat()
-                inner_way = inner_way + self.inner_ways[i_inner].print_bat
-            export.append(inner_way)
+            for inner_way in self.inner_ways:
+                inner_way.export_bat(emitted)
+            export.append("".join(inner_way.print_bat for inner_way in self.inner_ways))
             # export de la relation
             export.append(f'  <relation id="{self.relation_name}">')
             export.append('    <tag k="type" v="multipolygon"/>')
@@ -257,15 +308,7 @@ class Building:
             for ways in range(len(self.inner_ways)):
                 export.append(f'    <member type="way" ref="{self.inner_ways[ways].bat_id}" role="inner"/>')
             export.append('  </relation>')
-        nb_ligne = len(export)
-        i_ligne = 0
-        while i_ligne < nb_ligne:
-            if i_ligne == nb_ligne - 1:
-                res_export = res_export + export[i_ligne]
-            else:
-                res_export = res_export + export[i_ligne] + "\n"
-            i_ligne = i_ligne + 1
-        self.print_bat = res_export
+        self.print_bat = "\n".join(export)
 
     def copy_tag(self, other, status):
         """
@@ -275,30 +318,52 @@ class Building:
         hérité du batiment 'other'. Par contre lorsque le batiment 'self' est
         détecté comme modifié, la source est mis à jour pour prendre la valeur
         du batiment 'other'.
+        Les tags étant partagés, le batiment 'other' n'est jamais modifié :
+        la mise à jour de la source crée un nouveau jeu de tags.
         """
         log = logging.getLogger("copy_tag")
         tag_source_save = ""
         if status == "IDENTIQUE":
-            self.tag_count = other.tag_count
-            self.tableau_tag_key = other.tableau_tag_key
-            self.tableau_tag_value = other.tableau_tag_value
+            self.tags = other.tags
         elif status == "MODIFIE":
             try:
                 rang_tag_source = self.tableau_tag_key.index("source")
-                tag_source_save = self.tableau_tag_value[rang_tag_source]
+                tag_source_save = self.tags[rang_tag_source][1]
             except Exception as e:
                 log.error(e)
                 pass
-            self.tag_count = other.tag_count
-            self.tableau_tag_key = other.tableau_tag_key
-            self.tableau_tag_value = other.tableau_tag_value
+            self.tags = other.tags
             try:
                 rang_tag_source = self.tableau_tag_key.index("source")
-                self.tableau_tag_value[rang_tag_source] = tag_source_save
+                tags = list(self.tags)
+                tags[rang_tag_source] = ("source", tag_source_save)
+                self.tags = intern_tags(tags)
             except Exception as e:
                 log.error(e)
                 pass
 
+    @property
+    def tag_count(self):
+        return len(self.tags)
+
+    @property
+    def tableau_tag_key(self):
+        return [key for key, _ in self.tags]
+
+    @property
+    def tableau_tag_value(self):
+        return [value for _, value in self.tags]
+
+    def reset_matching(self):
+        """
+        Cette méthode remet le batiment dans l'état qui suit sa lecture :
+        le bâti actuel chargé par le serveur (voir CurrentBuildings) peut
+        ainsi être comparé à plusieurs cadastres successifs.
+        """
+        self.min_distance = 1000.0
+        self.set_close_building("")
+        self.set_status("UNKNOWN")
+
     def add_inner_way(self, other: str):
         """
         Cette méthode permet d'ajouter un batiment en tant que chemin intérieur
@@ -332,34 +397,1155 @@ def log_format(text: list, max_chars: int, split: str):
     return result
 
 
-def main():
+def read_building(way_id: str, nodes: list, tag_keys: list, tag_values: list, history: list):
+    """Cette fonction crée un batiment à partir des éléments lus pour un
+    chemin (dans un fichier osm ou dans une base) et calcule son centre de
+    gravité et sa largeur."""
+    log = logging.getLogger("read_building")
+    batiment = Building(way_id, len(nodes), nodes, len(tag_keys), tag_keys, tag_values, 1000, 0.0, "UNKNOWN")
+    batiment.compute_center()
+    if batiment.area_issue == "YES":
+        log.info(f"  Attention, surface nulle obtenue pour le batiment :{batiment.bat_id}")
+    batiment.compute_width()
+    batiment.set_history(history)
+    batiment.set_close_building("")
+    return batiment
+
+
+def is_building_relation(element) -> bool:
+    """Indique si une relation lue dans un fichier osm décrit un batiment :
+    multipolygone ou relation portant un tag building. Les autres relations
+    (associatedStreet, site...) ne doivent pas remplacer la relation d'un
+    chemin membre d'un multipolygone."""
+    for tag in element.iterfind("tag"):
+        if tag.get("k") == "building" or (tag.get("k") == "type" and tag.get("v") == "multipolygon"):
+            return True
+    return False
+
+
+def read_osm_file(osm_file: str, buildings_only: bool = False):
+    """Lecture en flux (iterparse) d'un fichier osm.
+
+    Retourne le dictionnaire des noeuds lus (id -> Point), la liste des
+    chemins sous forme de tuples (id, noeuds, clés des tags, valeurs des
+    tags, historique, relation, role) dans l'ordre du fichier et le nombre
+    de noeuds ignorés.
+
+    Avec buildings_only, une première passe relève les chemins portant un
+    tag building ou membres d'une relation building (relation portant un
+    tag building, ou multipolygone dont un chemin extérieur porte un tag
+    building) ainsi que les noeuds qu'ils utilisent : seuls ces chemins et
+    ces noeuds sont ensuite créés, les autres (adresses, POI, noeuds des
+    autres chemins) sont ignorés.
+    """
+    log = logging.getLogger("read_osm_file")
+    building_ways = None
+    used_nodes = None
+    if buildings_only:
+        building_ways = set()
+        used_nodes = set()
+        other_ways = {}
+        relation_members = set()
+        # multipolygones sans tag building : (chemins extérieurs, membres)
+        multipolygons = []
+        for _, element in lxml.etree.iterparse(osm_file, events=("end",), tag=("way", "relation")):
+            is_building = any(tag.get("k") == "building" for tag in element.iterfind("tag"))
+            if element.tag == "way":
+                refs = [nd.get("ref") for nd in element.iterfind("nd")]
+                if is_building:
+                    building_ways.add(element.get("id"))
+                    used_nodes.update(refs)
+                else:
+                    other_ways[element.get("id")] = refs
+            elif is_building:
+                for member in element.iterfind("member"):
+                    if member.get("type") == "way":
+                        relation_members.add(member.get("ref"))
+            elif is_building_relation(element):
+                members = [member for member in element.iterfind("member") if member.get("type") == "way"]
+                multipolygons.append(([member.get("ref") for member in members if member.get("role") == "outer"],
+                                      [member.get("ref") for member in members]))
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        # les multipolygones dont le tag building est porté par un chemin
+        # extérieur (ancien schéma) sont aussi des relations building
+        for outer_ways, members in multipolygons:
+            if any(way_id in building_ways for way_id in outer_ways):
+                relation_members.update(members)
+        # chemins sans tag building (chemins intérieurs) membres d'une relation building
+        for way_id in relation_members:
+            if way_id in other_ways:
+                building_ways.add(way_id)
+                used_nodes.update(other_ways[way_id])
+        del other_ways
+
+    points = {}
+    ways = []
+    relations = {}
+    skipped_nodes = 0
+    for _, element in lxml.etree.iterparse(osm_file, events=("end",), tag=("node", "way", "relation")):
+        if element.tag == "node":
+            node_id = element.get("id")
+            if used_nodes is not None and node_id not in used_nodes:
+                skipped_nodes = skipped_nodes + 1
+            elif node_id not in points:
+                points[node_id] = Point(node_id, element.get("lat"), element.get("lon"))
+                points[node_id].set_history([value for item in element.attrib.items() for value in item])
+        elif element.tag == "way":
+            way_id = element.get("id")
+            if building_ways is None or way_id in building_ways:
+                ways.append((
+                    way_id,
+                    [nd.get("ref") for nd in element.iterfind("nd")],
+                    [tag.get("k") for tag in element.iterfind("tag")],
+                    [tag.get("v") for tag in element.iterfind("tag")],
+                    [value for item in element.attrib.items() for value in item],
+                ))
+        elif is_building_relation(element):
+            for member in element.iterfind("member"):
+                if member.get("type", "way") == "way":
+                    relations[member.get("ref")] = (element.get("id"), member.get("role"))
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    # les chemins peuvent précéder leurs noeuds dans le fichier (sortie
+    # overpass par exemple) : les noeuds sont rattachés une fois le fichier lu
+    osm_ways = []
+    for way_id, refs, tag_keys, tag_values, history in ways:
+        if any(ref not in points for ref in refs):
+            log.warning(f"  chemin {way_id} ignoré : noeuds absents du fichier {osm_file}")
+            continue
+        relation, role = relations.get(way_id, (None, None))
+        osm_ways.append((way_id, [points[ref] for ref in refs], tag_keys, tag_values, history, relation, role))
+    return points, osm_ways, skipped_nodes
+
+
+def create_buildings(osm_ways, keep_history: bool) -> list:
+    """Cette fonction crée les batiments des chemins passés en paramètre
+    (tels que retournés par read_osm_file ou read_store) et reconstitue les
+    multipolygones. Les batiments sont retournés dans l'ordre des chemins."""
+    buildings = []
+    relations = {}
+    for way_id, tab_nodes, tab_key, tab_value, attributes, id_relation, role in osm_ways:
+        batiment_lu = read_building(way_id, tab_nodes, tab_key, tab_value, attributes if keep_history else [])
+        buildings.append(batiment_lu)
+        if id_relation:
+            relations.setdefault(id_relation, []).append((batiment_lu, role))
+    for id_relation, members in relations.items():
+        link_relation(id_relation, members)
+    return buildings
+
+
+def place_buildings(bati: dict, osm_ways: list, keep_history: bool,
+                    lat_min: float, lon_min: float, delta_lat: float, delta_lon: float, nb_zone: int):
+    """Cette fonction crée les batiments des chemins passés en paramètre
+    (voir create_buildings) et les range dans leur zone. Elle retourne le
+    nombre de batiments créés."""
+    buildings = create_buildings(osm_ways, keep_history)
+    for batiment_lu in buildings:
+        zone = zone_of(batiment_lu.center, lat_min, lon_min, delta_lat, delta_lon, nb_zone)
+        bati.setdefault(zone, []).append(batiment_lu)
+    return len(buildings)
+
+
+def link_relation(id_relation: str, members: list):
+    """Reconstitue un multipolygone à partir de ses membres, couples
+    (batiment, role) : les chemins intérieurs deviennent une dépendance du
+    premier chemin extérieur."""
+    outer_ways = [batiment for batiment, role in members if role == "outer"]
+    if not outer_ways:
+        return
+    outer_way = outer_ways[0]
+    outer_way.add_relation(id_relation)
+    outer_way.multipolygone = "yes"
+    for batiment, role in members:
+        if role != "outer":
+            batiment.set_role("inner")
+            outer_way.add_inner_way(batiment)
+
+
+def zone_of(center: Point, lat_min: float, lon_min: float, delta_lat: float, delta_lon: float, nb_zone: int):
+    """Cette fonction retourne la zone (i_lat, i_lon) qui contient le point
+    passé en paramètre. Les points hors de l'emprise sont ramenés dans les
+    zones du bord."""
+    repere_latitude = int((center.lat - lat_min) / delta_lat)
+    repere_longitude = int((center.lon - lon_min) / delta_lon)
+    repere_latitude = min(max(repere_latitude, 0), nb_zone - 1)
+    repere_longitude = min(max(repere_longitude, 0), nb_zone - 1)
+    return repere_latitude, repere_longitude
+
+
+def open_store(store_path: str):
+    """Ouvre (et crée si besoin) la base SQLite du bâti actuel.
+
+    La base contient les noeuds (coordonnées et historique osm), les
+    chemins (liste des noeuds, tags, historique et relation éventuelle) et
+    un index R*Tree des emprises des chemins.
+    """
+    connection = sqlite3.connect(store_path)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS node (
+            id INTEGER PRIMARY KEY,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            history TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS way (
+            id INTEGER PRIMARY KEY,
+            nodes TEXT NOT NULL,
+            tags TEXT NOT NULL,
+            history TEXT NOT NULL,
+            relation TEXT,
+            role TEXT
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS way_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+        CREATE TABLE IF NOT EXISTS ingest (
+            file TEXT NOT NULL,
+            date TEXT NOT NULL,
+            nodes INTEGER NOT NULL,
+            ways INTEGER NOT NULL
+        );
+    """)
+    return connection
+
+
+def ingest_osm_files(store_path: str, osm_files: list, reset: bool = False):
+    """Enregistre le bâti des fichiers osm passés en paramètre dans la base.
+
+    Les fichiers sont lus en flux (iterparse) pour ne pas charger tout le
+    document en mémoire. Un noeud ou un chemin déjà présent dans la base
+    est remplacé par la version lue dans le fichier.
+    """
+    log = logging.getLogger("ingest")
+    connection = open_store(store_path)
+    if reset:
+        connection.executescript("DELETE FROM node; DELETE FROM way; DELETE FROM way_rtree; DELETE FROM ingest;")
+    # chemins lus dans le fichier en cours, dont l'emprise reste à calculer
+    connection.execute("CREATE TEMP TABLE pending (id INTEGER PRIMARY KEY)")
+    for osm_file in osm_files:
+        log.info(f"ingestion du fichier {osm_file}...")
+        nodes_count = 0
+        for _, element in lxml.etree.iterparse(osm_file, events=("end",), tag=("node", "way", "relation")):
+            if element.tag == "node":
+                history = [value for item in element.attrib.items() for value in item]
+                connection.execute(
+                    "INSERT OR REPLACE INTO node VALUES (?, ?, ?, ?)",
+                    (int(element.get("id")), float(element.get("lat")), float(element.get("lon")),
+                     json.dumps(history)))
+                nodes_count = nodes_count + 1
+            elif element.tag == "way":
+                way_id = int(element.get("id"))
+                refs = [int(nd.get("ref")) for nd in element.iterfind("nd")]
+                tags = [[tag.get("k"), tag.get("v")] for tag in element.iterfind("tag")]
+                history = [value for item in element.attrib.items() for value in item]
+                connection.execute(
+                    "INSERT OR REPLACE INTO way VALUES (?, ?, ?, ?, NULL, NULL)",
+                    (way_id, json.dumps(refs), json.dumps(tags), json.dumps(history)))
+                connection.execute("INSERT OR IGNORE INTO pending VALUES (?)", (way_id,))
+            elif is_building_relation(element):
+                for member in element.iterfind("member"):
+                    if member.get("type") == "way":
+                        connection.execute(
+                            "UPDATE way SET relation = ?, role = ? WHERE id = ?",
+                            (element.get("id"), member.get("role"), int(member.get("ref"))))
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        # les chemins peuvent précéder leurs noeuds dans le fichier (sortie
+        # overpass par exemple) : l'index est donc construit une fois le
+        # fichier entièrement lu. Les coordonnées sont lues dans la base, ce
+        # qui permet d'ingérer un fichier plus gros que la mémoire.
+        incomplete_ways = connection.execute(
+            "SELECT way.id FROM pending JOIN way ON way.id = pending.id"
+            " WHERE json_array_length(way.nodes) = 0 OR EXISTS ("
+            "  SELECT 1 FROM json_each(way.nodes) AS ref LEFT JOIN node ON node.id = ref.value"
+            "  WHERE node.id IS NULL)").fetchall()
+        for (way_id,) in incomplete_ways:
+            log.warning(f"  chemin {way_id} ignoré : noeuds absents du fichier et de la base")
+            connection.execute("DELETE FROM way WHERE id = ?", (way_id,))
+        connection.execute("DELETE FROM way_rtree WHERE id IN (SELECT id FROM pending)")
+        ways_count = connection.execute(
+            "INSERT INTO way_rtree"
+            " SELECT way.id, min(node.lat), max(node.lat), min(node.lon), max(node.lon)"
+            " FROM pending JOIN way ON way.id = pending.id, json_each(way.nodes) AS ref"
+            " JOIN node ON node.id = ref.value GROUP BY way.id").rowcount
+        connection.execute("DELETE FROM pending")
+        connection.execute(
+            "INSERT INTO ingest VALUES (?, ?, ?, ?)",
+            (os.path.abspath(osm_file), time.strftime("%Y-%m-%d %H:%M:%S"), nodes_count, ways_count))
+        connection.commit()
+        log.info(f"  {nodes_count} noeuds et {ways_count} chemins enregistrés dans {store_path}")
+    connection.close()
+
+
+def iter_store_ways(connection: sqlite3.Connection, bbox: tuple = None, order: str = "way.id",
+                    batch_size: int = 1000):
+    """Parcourt les chemins de la base, par paquets de batch_size.
+
+    bbox (lat_min, lat_max, lon_min, lon_max) limite le parcours aux
+    chemins dont l'emprise intersecte la zone. Les noeuds de chaque paquet
+    sont lus en une fois : seul le paquet en cours est en mémoire.
+
+    Produit, pour chaque chemin, un tuple (id, noeuds, clés des tags,
+    valeurs des tags, historique, relation, role).
+    """
+    query = "SELECT way.id, way.nodes, way.tags, way.history, way.relation, way.role FROM way"
+    parameters = ()
+    if bbox is not None:
+        query = (query + " JOIN way_rtree ON way_rtree.id = way.id"
+                 " WHERE way_rtree.max_lat >= ? AND way_rtree.min_lat <= ?"
+                 " AND way_rtree.max_lon >= ? AND way_rtree.min_lon <= ?")
+        parameters = bbox
+    cursor = connection.execute(f"{query} ORDER BY {order}", parameters)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        ways = [(way_id, json.loads(refs), json.loads(tags), json.loads(history), relation, role)
+                for way_id, refs, tags, history, relation, role in rows]
+
+        node_ids = sorted({ref for way in ways for ref in way[1]})
+        points = {}
+        for i_start in range(0, len(node_ids), 500):
+            batch = node_ids[i_start:i_start + 500]
+            for node_id, lat, lon, history in connection.execute(
+                    f"SELECT id, lat, lon, history FROM node WHERE id IN ({','.join('?' * len(batch))})", batch):
+                points[node_id] = Point(str(node_id), lat, lon)
+                points[node_id].set_history(json.loads(history))
+
+        for way_id, refs, tags, history, relation, role in ways:
+            yield (
+                str(way_id),
+                [points[ref] for ref in refs],
+                [key for key, _ in tags],
+                [value for _, value in tags],
+                history,
+                relation,
+                role,
+            )
+
+
+def read_store(store_path: str, lat_min: float, lat_max: float, lon_min: float, lon_max: float):
+    """Lit dans la base les chemins dont l'emprise intersecte la zone
+    passée en paramètre.
+
+    Retourne le nombre de noeuds lus et, pour chaque chemin, un tuple
+    (id, noeuds, clés des tags, valeurs des tags, historique, relation, role).
+    """
+    if not os.path.exists(store_path):
+        raise FileNotFoundError(store_path)
+    connection = open_store(store_path)
+    store_ways = list(iter_store_ways(connection, (lat_min, lat_max, lon_min, lon_max)))
+    connection.close()
+    nodes_count = len({point.node_id for way in store_ways for point in way[1]})
+    return nodes_count, store_ways
+
+
+def ingest_main(argv: list):
+    """Point d'entrée de la commande ingest : python BatiOsm.py ingest base.sqlite fichier.osm..."""
     parser = argparse.ArgumentParser(
-        prog="BatiOsm",
-        description="Analyze two OSM files and prepare files to simplify imports and updates")
-    parser.add_argument("source", help="OSM source file", type=str)
-    parser.add_argument("buildings", help="File with Buildings, in general a cadastre export", type=str)
-    parser.add_argument("prefix", help="Prefix for generated files", type=str)
+        prog="BatiOsm ingest",
+        description="Store the current OSM buildings in a SQLite database for later comparisons")
+    parser.add_argument("store", help="SQLite database, created if needed", type=str)
+    parser.add_argument("files", help="OSM files with the current buildings", type=str, nargs="+")
+    parser.add_argument("--reset", help="Empty the database before ingestion", action='store_true')
     parser.add_argument("--debug", help="Enable debug", action='store_true')
+    args = parser.parse_args(argv)
 
-    args = parser.parse_args()
+    setup_logging(args.debug)
+    ingest_osm_files(args.store, args.files, args.reset)
+
+
+class ZoneSpill:
+    """Batiments d'un fichier rangés par zone et conservés sur disque.
+
+    Les batiments sont sérialisés (pickle) dans un fichier par ligne de
+    zones (i_lat), ce qui permet de ne recharger en mémoire que les lignes
+    en cours de traitement (voir iter_windows). Les écritures sont
+    regroupées dans un tampon de buffer_limit octets.
+    """
+
+    def __init__(self, directory: str, name: str, buffer_limit: int):
+        self.directory = directory
+        self.name = name
+        self.buffer_limit = buffer_limit
+        # taille sérialisée des batiments de chaque ligne de zones
+        self.row_bytes = {}
+        self.buffers = {}
+        self.buffered = 0
+
+    def path(self, row: int) -> str:
+        return os.path.join(self.directory, f"{self.name}_{row}.pickle")
+
+    def add(self, zone: tuple, batiment: Building):
+        data = pickle.dumps((zone, batiment), pickle.HIGHEST_PROTOCOL)
+        self.buffers.setdefault(zone[0], []).append(data)
+        self.row_bytes[zone[0]] = self.row_bytes.get(zone[0], 0) + len(data)
+        self.buffered = self.buffered + len(data)
+        if self.buffered > self.buffer_limit:
+            self.flush()
+
+    def flush(self):
+        for row, chunks in self.buffers.items():
+            with open(self.path(row), "ab") as spill_file:
+                spill_file.writelines(chunks)
+        self.buffers = {}
+        self.buffered = 0
+
+    def load(self, rows) -> dict:
+        """Relit les batiments des lignes de zones passées en paramètre."""
+        bati = {}
+        for row in rows:
+            if row not in self.row_bytes:
+                continue
+            with open(self.path(row), "rb") as spill_file:
+                while True:
+                    try:
+                        zone, batiment = pickle.load(spill_file)
+                    except EOFError:
+                        break
+                    # les jeux de tags relus sont à nouveau partagés
+                    batiment.tags = intern_tags(batiment.tags)
+                    bati.setdefault(zone, []).append(batiment)
+        return bati
+
+
+def spill_buildings(spill: ZoneSpill, osm_ways, keep_history: bool,
+                    lat_min: float, lon_min: float, delta_lat: float, delta_lon: float, nb_zone: int):
+    """Equivalent de place_buildings pour un parcours de chemins qui ne
+    tient pas en mémoire : les batiments sont rangés dans spill au fur et
+    à mesure. Les membres d'une même relation doivent se suivre dans
+    osm_ways (voir iter_store_ways), pour reconstituer les multipolygones
+    avant de les ranger. Retourne le nombre de batiments créés."""
+    nb_batiments = 0
+    for id_relation, ways in itertools.groupby(osm_ways, key=lambda way: way[5]):
+        members = []
+        for way_id, tab_nodes, tab_key, tab_value, attributes, _, role in ways:
+            batiment_lu = read_building(way_id, tab_nodes, tab_key, tab_value, attributes if keep_history else [])
+            nb_batiments = nb_batiments + 1
+            if id_relation:
+                members.append((batiment_lu, role))
+            else:
+                spill.add(zone_of(batiment_lu.center, lat_min, lon_min, delta_lat, delta_lon, nb_zone), batiment_lu)
+        if members:
+            link_relation(id_relation, members)
+            for batiment_lu, _ in members:
+                spill.add(zone_of(batiment_lu.center, lat_min, lon_min, delta_lat, delta_lon, nb_zone), batiment_lu)
+    spill.flush()
+    return nb_batiments
+
+
+def iter_windows(old_spill: ZoneSpill, new_spill: ZoneSpill, nb_zone: int, memory_limit: int):
+    """Découpe la grille en bandes de lignes de zones traitées l'une après
+    l'autre.
+
+    Une bande contient autant de lignes que possible tant que ses
+    batiments, ceux des deux lignes voisines comprises, tiennent dans
+    memory_limit octets (estimés à SPILL_MEMORY_FACTOR fois leur taille
+    sérialisée), et au moins une ligne. Les lignes voisines sont chargées
+    pour que les batiments en bord de bande soient comparés à tous leurs
+    voisins : seuls les batiments des lignes row_inf à row_sup - 1 sont
+    ensuite classés.
+
+    Produit pour chaque bande les anciens et les nouveaux batiments
+    chargés, row_inf et row_sup.
+    """
+    row_sizes = [old_spill.row_bytes.get(row, 0) + new_spill.row_bytes.get(row, 0) for row in range(nb_zone)]
+    row_inf = 0
+    while row_inf < nb_zone:
+        row_sup = row_inf + 1
+        while (row_sup < nb_zone and
+               sum(row_sizes[max(row_inf - 1, 0):row_sup + 2]) * SPILL_MEMORY_FACTOR <= memory_limit):
+            row_sup = row_sup + 1
+        rows = range(max(row_inf - 1, 0), min(row_sup + 1, nb_zone))
+        yield old_spill.load(rows), new_spill.load(rows), row_inf, row_sup
+        row_inf = row_sup
+
+
+def export_chunk(buildings: list, emitted: set = None) -> str:
+    """Cette fonction retourne la version xml d'une liste de batiments.
+    Les noeuds de emitted, déjà écrits dans le fichier, ne sont pas répétés
+    (voir Building.export_bat)."""
+    export = []
+    for batiment in buildings:
+        batiment.export_bat(emitted)
+        export.append(batiment.print_bat + "\n")
+    return "".join(export)
+
+
+# Listes de batiments en cours d'export, héritées par les processus fils
+# de write_buildings (voir export_range)
+_EXPORT_BUILDINGS = None
+
+
+def export_range(i_export: int, start: int, stop: int, emitted: set) -> str:
+    """Cette fonction est exécutée dans un processus fils lorsque l'export
+    est parallélisé : elle sérialise les batiments start à stop de la liste
+    i_export, héritée du processus principal au moment du fork. Seuls ces
+    indices et les noeuds déjà écrits sont transmis au processus fils, et
+    non les batiments eux-mêmes."""
+    return export_chunk(_EXPORT_BUILDINGS[i_export][start:stop], emitted)
+
+
+def building_node_ids(batiment: Building):
+    """Identifiants (entiers) des noeuds écrits avec un batiment, y compris
+    ceux de ses chemins intérieurs."""
+    for point in batiment.nodes:
+        yield int(point.node_id)
+    if batiment.multipolygone == "yes":
+        for inner_way in batiment.inner_ways:
+            yield from building_node_ids(inner_way)
+
+
+def export_jobs(jobs: int) -> int:
+    """Nombre de processus réellement utilisés pour l'export : pas plus que
+    de processeurs, et un seul sans fork (Windows)."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return 1
+    return max(min(jobs, os.cpu_count() or 1), 1)
+
+
+def export_chunks(exports: list, executor, jobs: int):
+    """Sérialise les batiments des exports (voir write_buildings) par paquets
+    de EXPORT_CHUNK_SIZE et génère les couples (chemin du fichier, xml du
+    paquet) dans l'ordre des fichiers et des batiments. Avec un executor, au
+    plus 2 * jobs paquets sont en cours de sérialisation : chaque paquet est
+    rendu dès qu'il est prêt et que les précédents ont été rendus."""
+    pending = collections.deque()
+    for i_export, (file_name, buildings, emitted) in enumerate(exports):
+        for i_bat in range(0, len(buildings), EXPORT_CHUNK_SIZE):
+            chunk = buildings[i_bat:i_bat + EXPORT_CHUNK_SIZE]
+            # seuls les noeuds du paquet déjà écrits par les paquets
+            # précédents sont transmis : les doublons internes au paquet
+            # sont écartés par export_chunk
+            chunk_ids = {node_id for batiment in chunk for node_id in building_node_ids(batiment)}
+            chunk_emitted = chunk_ids & emitted
+            emitted |= chunk_ids
+            if executor is None:
+                yield file_name, export_chunk(chunk, chunk_emitted)
+                continue
+            # le paquet est sérialisé pendant la préparation des suivants
+            pending.append((file_name, executor.submit(
+                export_range, i_export, i_bat, i_bat + EXPORT_CHUNK_SIZE, chunk_emitted)))
+            if len(pending) >= 2 * jobs:
+                ready_name, future = pending.popleft()
+                yield ready_name, future.result()
+    while pending:
+        ready_name, future = pending.popleft()
+        yield ready_name, future.result()
+
+
+def write_buildings(exports: list, jobs: int = 1):
+    """Ajout de batiments à la fin de fichiers osm.
+
+    exports est une liste de triplets (chemin du fichier, batiments,
+    noeuds déjà écrits dans le fichier). Chaque noeud n'est écrit qu'une
+    fois par fichier : l'ensemble des noeuds écrits est complété ici.
+    Les batiments sont sérialisés par paquets (voir export_chunks), écrits
+    au fur et à mesure dans leur fichier. Avec jobs > 1 et au moins
+    EXPORT_PARALLEL_MIN_BUILDINGS batiments, les paquets sont sérialisés en
+    parallèle par des processus fils créés par fork, qui héritent des
+    batiments (voir export_range) : le contenu des fichiers est identique à
+    celui de l'export séquentiel. Les processus fils ne voient que les
+    batiments existant lors de leur création et sont donc recréés à chaque
+    appel. Un seul fichier est ouvert à la fois.
+    """
+    global _EXPORT_BUILDINGS
+    log = logging.getLogger("write_buildings")
+    executor = None
+    jobs = export_jobs(jobs)
+    nb_bat = sum(len(buildings) for _, buildings, _ in exports)
+    if jobs > 1 and nb_bat >= EXPORT_PARALLEL_MIN_BUILDINGS:
+        log.info(f"  export parallèle de {nb_bat} batiments sur {jobs} processus")
+        _EXPORT_BUILDINGS = [buildings for _, buildings, _ in exports]
+        # les objets existants sont retirés du suivi du ramasse-miettes : sans
+        # cela, chaque collecte dans un processus fils écrit dans tous les
+        # objets hérités et recopie la mémoire du processus principal
+        gc.freeze()
+        executor = concurrent.futures.ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("fork"))
+    try:
+        for file_name, file_chunks in itertools.groupby(export_chunks(exports, executor, jobs),
+                                                        key=lambda chunk: chunk[0]):
+            with open(file_name, "a") as osm_file:
+                for _, chunk in file_chunks:
+                    osm_file.write(chunk)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+            gc.unfreeze()
+            _EXPORT_BUILDINGS = None
+
+
+def hilbert_index(x: int, y: int, order: int = CURVE_ORDER) -> int:
+    """Rang du point (x, y) sur la courbe de Hilbert d'ordre order
+    (coordonnées entières de 0 à 2**order - 1)."""
+    size = 1 << order
+    index = 0
+    s = size >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        index = index + s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = size - 1 - x
+                y = size - 1 - y
+            x, y = y, x
+        s = s >> 1
+    return index
+
+
+def spread_bits(value: int) -> int:
+    """Intercale un bit nul entre les 16 bits de poids faible de value."""
+    value = value & 0xFFFF
+    value = (value | (value << 8)) & 0x00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F
+    value = (value | (value << 2)) & 0x33333333
+    value = (value | (value << 1)) & 0x55555555
+    return value
+
+
+def spatial_keys(points: list, lat_min: float, lat_max: float, lon_min: float, lon_max: float,
+                 curve: str = "hilbert") -> list:
+    """Clés de tri spatial d'une liste de points.
+
+    Les coordonnées sont ramenées à une grille de 2**CURVE_ORDER cases de
+    côté sur l'emprise passée en paramètre (les points en dehors sont
+    ramenés au bord), puis numérotées le long de la courbe de Hilbert
+    ("hilbert") ou de la courbe de Morton ("zorder"). Des points proches
+    ont le plus souvent des clés proches.
+    """
+    scale = (1 << CURVE_ORDER) - 1
+    lat_scale = scale / (lat_max - lat_min) if lat_max > lat_min else 0.0
+    lon_scale = scale / (lon_max - lon_min) if lon_max > lon_min else 0.0
+    keys = []
+    for point in points:
+        x = min(max(int((point.lon - lon_min) * lon_scale), 0), scale)
+        y = min(max(int((point.lat - lat_min) * lat_scale), 0), scale)
+        if curve == "hilbert":
+            keys.append(hilbert_index(x, y))
+        else:
+            keys.append(spread_bits(x) | (spread_bits(y) << 1))
+    return keys
+
+
+def building_summary(batiment: Building) -> list:
+    """Colonnes du récapitulatif d'un batiment dans le fichier de log."""
+    return [
+        batiment.bat_id,
+        batiment.status,
+        str(round(batiment.min_distance, 9)),
+        str(round(batiment.center.lat, 7)),
+        str(round(batiment.center.lon, 7)),
+        str(round(batiment.area, 1)),
+    ]
+
+
+class ResultFiles:
+    """Fichiers résultats d'une comparaison, écrits au fur et à mesure.
+
+    Les batiments sont ajoutés zone par zone (write) dans des fichiers
+    temporaires, renommés par close une fois connu le nombre de batiments
+    qu'ils contiennent, qui figure dans leur nom. Les récapitulatifs par
+    batiment du fichier de log sont conservés de la même façon dans des
+    fichiers temporaires (voir copy_section).
+
+    Chaque catégorie peut être découpée en plusieurs fichiers : au plus
+    split_count batiments par fichier, ou un fichier par dalle de
+    split_tile degrés de côté (selon le centre des batiments). La liste
+    des fichiers, avec leur emprise et leur nombre de batiments, est alors
+    enregistrée dans prefix_index.json.
+
+    Avec spatial_order ("hilbert" ou "zorder"), les batiments de chaque
+    appel à write sont écrits dans l'ordre d'une courbe de remplissage
+    (voir spatial_keys), avant d'être répartis entre les fichiers.
+    """
 
+    def __init__(self, base_path: str, file_prefix: str, jobs: int = 1,
+                 split_count: int = None, split_tile: float = None,
+                 spatial_order: str = "none", bounds: tuple = None):
+        self.base_path = base_path
+        self.file_prefix = file_prefix
+        self.split_count = split_count
+        self.split_tile = split_tile
+        self.spatial_order = spatial_order
+        # emprise (lat_min, lat_max, lon_min, lon_max) utilisée par spatial_keys
+        self.bounds = bounds
+        self.jobs = jobs
+        self.counts = dict.fromkeys(RESULT_FILES, 0)
+        # fichiers de chaque catégorie dans l'ordre de leur création, et
+        # clé de découpage -> rang du fichier
+        self.shards = {status: [] for status in RESULT_FILES}
+        self.shard_keys = {status: {} for status in RESULT_FILES}
+        if not split_count and not split_tile:
+            # sans découpage, les quatre fichiers sont écrits même vides
+            for status in RESULT_FILES:
+                self.new_shard(status, None)
+        # récapitulatifs des batiments (recap_new, recap_old) et liste des
+        # nouveaux et des anciens batiments (new, old), dont le nom du
+        # fichier résultat est ajouté par copy_section
+        self.sections = {name: tempfile.TemporaryFile("w+") for name in ("recap_new", "recap_old", "new", "old")}
+
+    def new_shard(self, status: str, key) -> int:
+        shard = {
+            "key": key,
+            "part": os.path.join(
+                self.base_path, f"{self.file_prefix}_{RESULT_FILES[status]}_{len(self.shards[status])}.osm.part"),
+            "first": self.counts[status] + 1,
+            "count": 0,
+            "bbox": None,
+            # identifiants des noeuds déjà écrits dans le fichier
+            "emitted": set(),
+        }
+        with open(shard["part"], "w") as osm_file:
+            osm_file.write('<?xml version="1.0" encoding="UTF-8"?>' + "\n")
+            osm_file.write('<osm version="0.6" upload="true" generator="JOSM">' + "\n")
+        self.shards[status].append(shard)
+        self.shard_keys[status][key] = len(self.shards[status]) - 1
+        return len(self.shards[status]) - 1
+
+    def add(self, status: str, batiment: Building) -> int:
+        """Range un batiment dans le fichier de sa catégorie dont il relève
+        et retourne le rang de ce fichier."""
+        key = None
+        if self.split_count:
+            key = self.counts[status] // self.split_count
+        elif self.split_tile:
+            key = (math.floor(batiment.center.lat / self.split_tile),
+                   math.floor(batiment.center.lon / self.split_tile))
+        index = self.shard_keys[status].get(key)
+        if index is None:
+            index = self.new_shard(status, key)
+        shard = self.shards[status][index]
+        shard["count"] = shard["count"] + 1
+        self.counts[status] = self.counts[status] + 1
+        if key is not None:
+            # l'emprise ne sert qu'à prefix_index.json, écrit avec découpage
+            latitudes = [point.lat for point in batiment.nodes]
+            longitudes = [point.lon for point in batiment.nodes]
+            bbox = (min(latitudes), max(latitudes), min(longitudes), max(longitudes))
+            if shard["bbox"] is not None:
+                bbox = (min(bbox[0], shard["bbox"][0]), max(bbox[1], shard["bbox"][1]),
+                        min(bbox[2], shard["bbox"][2]), max(bbox[3], shard["bbox"][3]))
+            shard["bbox"] = bbox
+        return index
+
+    def file_name(self, status: str, index: int) -> str:
+        shard = self.shards[status][index]
+        name = f"{self.file_prefix}_{RESULT_FILES[status]}"
+        if self.split_tile:
+            return f"{name}_tile_{shard['key'][0]}_{shard['key'][1]}.osm"
+        if self.split_count or status != "IDENTIQUE":
+            return f"{name}_{shard['first']}_a_{shard['first'] + shard['count'] - 1}.osm"
+        return f"{name}.osm"
+
+    def files(self) -> list:
+        """Chemins des fichiers résultats, après close."""
+        files = [os.path.join(self.base_path, self.file_name(status, index))
+                 for status in RESULT_FILES for index in range(len(self.shards[status]))]
+        if self.split_count or self.split_tile:
+            files.append(os.path.join(self.base_path, f"{self.file_prefix}_index.json"))
+        return files
+
+    def write(self, old_bati: dict, new_bati: dict):
+        """Ajoute les batiments classés des zones passées en paramètre, dans
+        l'ordre des zones, ou dans l'ordre de la courbe spatial_order."""
+        # batiments à écrire de chaque catégorie, dans l'ordre des zones
+        categories = {status: [] for status in RESULT_FILES}
+        for zone in sorted(new_bati):
+            for batiment in new_bati[zone]:
+                self.sections["recap_new"].write(log_format(building_summary(batiment), 16, "|") + "\n")
+                if batiment.role == "outer" and batiment.status in ("IDENTIQUE", "MODIFIE", "NOUVEAU"):
+                    categories[batiment.status].append(batiment)
+        for zone in sorted(old_bati):
+            for batiment in old_bati[zone]:
+                self.sections["recap_old"].write(log_format(building_summary(batiment), 16, "|") + "\n")
+                if batiment.role == "outer" and batiment.status == "SUPPRIME":
+                    categories["SUPPRIME"].append(batiment)
+
+        # (status, rang du fichier) -> batiments à écrire
+        exports = {}
+        # id(batiment) -> rang du fichier, pour le récapitulatif
+        shard_of = {}
+        for status, buildings in categories.items():
+            if self.spatial_order != "none":
+                keys = spatial_keys([batiment.center for batiment in buildings], *self.bounds, self.spatial_order)
+                buildings = [buildings[i_bat] for i_bat in sorted(range(len(buildings)), key=keys.__getitem__)]
+            for batiment in buildings:
+                index = self.add(status, batiment)
+                shard_of[id(batiment)] = index
+                exports.setdefault((status, index), []).append(batiment)
+
+        for zone in sorted(new_bati):
+            for batiment in new_bati[zone]:
+                if id(batiment) in shard_of:
+                    line = [
+                        batiment.status,
+                        batiment.bat_id,
+                        str(round(batiment.min_distance, 9)),
+                        batiment.close_building_id,
+                    ]
+                    self.sections["new"].write(
+                        f"{batiment.status} {shard_of[id(batiment)]}\t{log_format(line, 16, '|')}\n")
+        for batiment in categories["SUPPRIME"]:
+            line = [
+                "SUPPRIME",
+                batiment.bat_id,
+                str(round(batiment.min_distance, 9)),
+            ]
+            self.sections["old"].write(f"SUPPRIME {shard_of[id(batiment)]}\t{log_format(line, 16, '|')}\n")
+        write_buildings([(self.shards[status][index]["part"], buildings, self.shards[status][index]["emitted"])
+                         for (status, index), buildings in sorted(exports.items())], self.jobs)
+
+    def close(self):
+        """Termine et renomme les fichiers osm, puis écrit l'index des
+        fichiers en cas de découpage."""
+        index_entries = []
+        for status in RESULT_FILES:
+            for index, shard in enumerate(self.shards[status]):
+                with open(shard["part"], "a") as osm_file:
+                    osm_file.write("</osm>")
+                shard["emitted"] = None
+                file_name = self.file_name(status, index)
+                os.replace(shard["part"], os.path.join(self.base_path, file_name))
+                min_lat, max_lat, min_lon, max_lon = shard["bbox"] or (None, None, None, None)
+                index_entries.append({
+                    "file": file_name,
+                    "status": status,
+                    "buildings": shard["count"],
+                    "bbox": {"min_lat": min_lat, "max_lat": max_lat, "min_lon": min_lon, "max_lon": max_lon},
+                })
+        if self.split_count or self.split_tile:
+            index_file_name = os.path.join(self.base_path, f"{self.file_prefix}_index.json")
+            with open(index_file_name, "w", encoding="utf-8") as index_file:
+                json.dump({"split_count": self.split_count, "split_tile": self.split_tile, "files": index_entries},
+                          index_file, ensure_ascii=False, indent=2)
+                index_file.write("\n")
+
+    def copy_section(self, name: str, file_log):
+        """Recopie une section du récapitulatif dans le fichier de log."""
+        section = self.sections[name]
+        section.seek(0)
+        for line in section:
+            if "\t" in line:
+                shard, line = line.rstrip("\n").split("\t", 1)
+                status, index = shard.split(" ")
+                line = line + log_format([self.file_name(status, int(index))], 16, "|") + "\n"
+            file_log.write(line)
+        section.close()
+
+
+def match_zones(old_bati: dict, new_bati: dict, nb_zone: int,
+                borne_inf: float = BORNE_INF_MODIF, borne_sup: float = BORNE_SUP_MODIF,
+                zone_comparisons: dict = None):
+    """Calcul des distances mini entre anciens et nouveaux batiments.
+
+    Pour chaque batiment ancien (resp. nouveau) on détermine la distance
+    la plus petite avec les nouveaux batiments (resp. anciens) de sa zone
+    et des zones voisines. Chaque couple de batiments n'est examiné qu'une
+    fois : la distance calculée met à jour les deux batiments, y compris la
+    copie des tags de l'ancien batiment vers le nouveau. Les candidats sont
+    examinés dans l'ordre des zones, comme avec deux passes séparées.
+    Les tags sont copiés selon les bornes borne_inf et borne_sup (en mètres).
+    Retourne le nombre de comparaisons effectuées. Si zone_comparisons est
+    fourni, le nombre de comparaisons de chaque zone (celle de l'ancien
+    batiment) y est enregistré.
+    """
+    outer_new = {}
+    for zone, batiments in new_bati.items():
+        outer_new[zone] = [batiment for batiment in batiments if batiment.role == "outer"]
+    nb_bat_total = sum(len(zone) for zone in old_bati.values())
+    nb_bat_traite = 0
+    nb_comparaison = 0
+    for (i_lat, i_lon) in sorted(old_bati):
+        nb_comparaison_zone = nb_comparaison
+        lat_inf = max(i_lat - 1, 0)
+        lon_inf = max(i_lon - 1, 0)
+        lat_sup = min(i_lat + 1, nb_zone - 1) + 1
+        lon_sup = min(i_lon + 1, nb_zone - 1) + 1
+        for old_bat in old_bati[(i_lat, i_lon)]:
+            nb_bat_traite = nb_bat_traite + 1
+            if old_bat.role != "outer":
+                continue
+            avancement = float(nb_bat_traite) / nb_bat_total * 100.0
+            sys.stdout.write(f'Calcul en cours : {int(avancement)} % {chr(13)}')
+            for n_lat in range(lat_inf, lat_sup):
+                for n_lon in range(lon_inf, lon_sup):
+                    for new_bat in outer_new.get((n_lat, n_lon), ()):
+                        distance = old_bat.center.distance(new_bat.center)
+                        nb_comparaison = nb_comparaison + 1
+                        if old_bat.min_distance > distance:
+                            old_bat.set_min_distance(distance)
+                            old_bat.set_close_building(new_bat.bat_id)
+                        if new_bat.min_distance > distance:
+                            new_bat.set_min_distance(distance)
+                            new_bat.set_close_building(old_bat.bat_id)
+                            if distance < borne_inf:
+                                new_bat.copy_tag(old_bat, "IDENTIQUE")
+                            elif borne_inf < distance < borne_sup:
+                                new_bat.copy_tag(old_bat, "MODIFIE")
+        if zone_comparisons is not None:
+            zone_comparisons[(i_lat, i_lon)] = nb_comparaison - nb_comparaison_zone
+    return nb_comparaison
+
+
+def classify_zones(old_bati: dict, new_bati: dict,
+                   borne_inf: float = BORNE_INF_MODIF, borne_sup: float = BORNE_SUP_MODIF):
+    """Classement des batiments, vérification de l'équilibre et comptage.
+
+    Les trois opérations sont faites en une seule passe sur les zones
+    occupées (old_bati et new_bati associent (i_lat, i_lon) à la liste des
+    batiments de la zone) :
+     - dist_mini < borne_inf : identique
+     - borne_inf < dist_mini < borne_sup : modifié
+     - dist_mini > borne_sup : nouveau ou supprimé
+     - dist_mini > largeur : nouveau ou supprimé
+    On vérifie ensuite pour chaque zone que :
+        nb_bat_apres = nb_bat_avant + nouveaux - supprimés
+    si l'équation n'est pas vérifiée et que la zone compte des batiments
+    modifiés suffisant pour rétablir l'équilibre, alors on déclare les
+    batiments modifiés comme nouveaux sinon la zone est signalée.
+
+    Retourne le nombre de batiments de chaque status et la liste des zones
+    en erreur d'équilibre, sous forme de tuples
+    ((i_lat, i_lon), avant, après, nouveaux, supprimés, modifiés).
+    """
+    status_count = {"IDENTIQUE": 0, "MODIFIE": 0, "NOUVEAU": 0, "SUPPRIME": 0}
+    balance_errors = []
+    for zone in sorted(old_bati.keys() | new_bati.keys()):
+        old_zone = old_bati.get(zone, [])
+        new_zone = new_bati.get(zone, [])
+        nb_supprimes = 0
+        nb_nouveaux = 0
+        nb_modifies = 0
+        nb_identiques = 0
+        for batiment in old_zone:
+            if batiment.role == "outer":
+                if batiment.min_distance > borne_sup or batiment.min_distance > batiment.width:
+                    batiment.set_status("SUPPRIME")
+                    nb_supprimes = nb_supprimes + 1
+        for batiment in new_zone:
+            if batiment.role == "outer":
+                if batiment.min_distance < borne_inf:
+                    batiment.set_status("IDENTIQUE")
+                elif borne_inf < batiment.min_distance < borne_sup:
+                    batiment.set_status("MODIFIE")
+                elif batiment.min_distance > borne_sup:
+                    batiment.set_status("NOUVEAU")
+                if batiment.min_distance > batiment.width:
+                    batiment.set_status("NOUVEAU")
+                if batiment.status == "NOUVEAU":
+                    nb_nouveaux = nb_nouveaux + 1
+                elif batiment.status == "MODIFIE":
+                    nb_modifies = nb_modifies + 1
+                elif batiment.status == "IDENTIQUE":
+                    nb_identiques = nb_identiques + 1
+        nb_bat_apres = len(new_zone)
+        nb_bat_avant = len(old_zone)
+        if nb_bat_apres != nb_bat_avant + nb_nouveaux - nb_supprimes:
+            if nb_bat_apres == nb_bat_avant + nb_nouveaux + nb_modifies - nb_supprimes:
+                for batiment in new_zone:
+                    if batiment.status == "MODIFIE":
+                        batiment.set_status("NOUVEAU")
+                nb_nouveaux = nb_nouveaux + nb_modifies
+                nb_modifies = 0
+            else:
+                balance_errors.append((zone, nb_bat_avant, nb_bat_apres, nb_nouveaux, nb_supprimes, nb_modifies))
+        status_count["SUPPRIME"] = status_count["SUPPRIME"] + nb_supprimes
+        status_count["NOUVEAU"] = status_count["NOUVEAU"] + nb_nouveaux
+        status_count["MODIFIE"] = status_count["MODIFIE"] + nb_modifies
+        status_count["IDENTIQUE"] = status_count["IDENTIQUE"] + nb_identiques
+    return status_count, balance_errors
+
+
+def open_debug_file(debug_file_name: str, lat_min: float, lat_max: float, lon_min: float, lon_max: float,
+                    delta_lat: float, delta_lon: float, nb_zone: int):
+    """Ouvre le fichier de debug et y sauvegarde les zones définies. Les
+    centres des batiments y sont ensuite ajoutés au fil du traitement."""
+    node_id = 100000
+    way_id = 1
+    file_debug = open(debug_file_name, "w")
+    file_debug.write('<?xml version="1.0" encoding="UTF-8"?>' + "\n")
+    file_debug.write('<osm version="0.6" upload="true" generator="JOSM">' + "\n")
+    for i_lat in range(nb_zone):
+        lat = lat_min + i_lat * delta_lat
+        node1 = f'  <node id="-{node_id}" action="modify" visible="true" lat="{lat}" lon="{lon_min}" />'
+        node2 = f'  <node id="-{node_id + 1}" action="modify" visible="true" lat="{lat}" lon="{lon_max}" />'
+        way1 = f'  <way id="-{way_id}" action="modify"' + ' visible="true">'
+        way2 = f'    <nd ref="-{node_id}" />'
+        way3 = f'    <nd ref="-{node_id + 1}" />'
+        way4 = f"  </way>"
+        file_debug.write(node1 + "\n")
+        file_debug.write(node2 + "\n")
+        file_debug.write(way1 + "\n")
+        file_debug.write(way2 + "\n")
+        file_debug.write(way3 + "\n")
+        file_debug.write(way4 + "\n")
+        node_id = node_id + 2
+        way_id = way_id + 1
+    for i_lon in range(nb_zone):
+        lon = lon_min + i_lon * delta_lon
+        node1 = f'  <node id="-{node_id}" action="modify" visible="true" lat="{lat_min}" lon="{lon}" />'
+        node2 = f'  <node id="-{node_id + 1}" action="modify" visible="true" lat="{lat_max}" lon="{lon}" />'
+        way1 = f'  <way id="-{way_id}" action="modify"' + ' visible="true">'
+        way2 = f'    <nd ref="-{node_id}" />'
+        way3 = f'    <nd ref="-{node_id + 1}" />'
+        way4 = "  </way>"
+        file_debug.write(node1 + "\n")
+        file_debug.write(node2 + "\n")
+        file_debug.write(way1 + "\n")
+        file_debug.write(way2 + "\n")
+        file_debug.write(way3 + "\n")
+        file_debug.write(way4 + "\n")
+        node_id = node_id + 2
+        way_id = way_id + 1
+    return file_debug
+
+
+def setup_logging(debug: bool):
     param = dict(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.INFO)
-    if args.debug:
+    if debug:
         param['level'] = logging.DEBUG
     if sys.version_info >= (3, 8, 0):
         param['force'] = True
     logging.basicConfig(**param)
 
-    log = logging.getLogger("main")
-    log.info("Start")
 
-    osm_file_current = args.source
-    osm_file_future = args.buildings
-    file_prefix = args.prefix
+class CurrentBuildings:
+    """Bâti actuel chargé une fois pour toutes par le serveur (voir
+    serve_main) puis comparé à des cadastres successifs (voir compare).
 
-    base_path = os.getcwd()
+    Les batiments sont créés au chargement (centres, largeurs et
+    multipolygones) et seulement rangés dans les zones de chaque cadastre.
+    Lorsque le bâti est lu dans une base (store), seuls les batiments dont
+    l'emprise intersecte celle du cadastre sont comparés, comme avec
+    read_store : ils sont retrouvés grâce à un index en grille de cellules
+    de INDEX_CELL_SIZE degrés.
+    """
+
+    def __init__(self, source: str, store: bool = False, skip_unused_nodes: bool = False):
+        self.source = source
+        self.store = store
+        self.skip_unused_nodes = skip_unused_nodes
+        self.buildings = []
+        self.bounds = []
+        self.cells = {}
+        self.nodes_count = 0
+        self.skipped_count = 0
+        self.loaded_at = None
+        self.load()
+
+    def load(self, source: str = None):
+        """(Re)lit le bâti actuel, éventuellement depuis une autre source.
+
+        Le bâti chargé n'est remplacé qu'une fois la lecture réussie : en cas
+        d'erreur, le serveur continue de comparer au bâti précédent.
+        """
+        log = logging.getLogger("serve")
+        source = source or self.source
+        tps = time.perf_counter()
+        if self.store:
+            log.info(f"lecture de la base {source}...")
+            if not os.path.exists(source):
+                raise FileNotFoundError(source)
+            connection = open_store(source)
+            ways = list(iter_store_ways(connection))
+            connection.close()
+            nodes_count = len({point.node_id for way in ways for point in way[1]})
+            skipped_count = 0
+        else:
+            log.info(f"lecture du fichier {source}...")
+            nodes, ways, skipped_count = read_osm_file(source, self.skip_unused_nodes)
+            nodes_count = len(nodes)
+            del nodes
+        buildings = create_buildings(ways, True)
+        del ways
+        all_bounds = []
+        cells = {}
+        for i_bat, batiment in enumerate(buildings):
+            latitudes = [point.lat for point in batiment.nodes]
+            longitudes = [point.lon for point in batiment.nodes]
+            bounds = (min(latitudes), max(latitudes), min(longitudes), max(longitudes))
+            all_bounds.append(bounds)
+            for cell in self.cells_of(*bounds):
+                cells.setdefault(cell, []).append(i_bat)
+        self.source = source
+        self.buildings = buildings
+        self.bounds = all_bounds
+        self.cells = cells
+        self.nodes_count = nodes_count
+        self.skipped_count = skipped_count
+        self.loaded_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        log.info(f"  {self.nodes_count} noeuds et {len(self.buildings)} batiments chargés"
+                 f" en {time.perf_counter() - tps} secondes")
+
+    @staticmethod
+    def cells_of(lat_min: float, lat_max: float, lon_min: float, lon_max: float):
+        for cell_lat in range(math.floor(lat_min / INDEX_CELL_SIZE), math.floor(lat_max / INDEX_CELL_SIZE) + 1):
+            for cell_lon in range(math.floor(lon_min / INDEX_CELL_SIZE), math.floor(lon_max / INDEX_CELL_SIZE) + 1):
+                yield cell_lat, cell_lon
+
+    def status(self) -> dict:
+        return {
+            "source": self.source,
+            "store": self.store,
+            "nodes": self.nodes_count,
+            "buildings": len(self.buildings),
+            "loaded_at": self.loaded_at,
+        }
+
+    def place(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float,
+              delta_lat: float, delta_lon: float, nb_zone: int):
+        """Range les batiments dans les zones d'un cadastre, après avoir
+        effacé le résultat de la comparaison précédente.
+
+        Retourne le nombre de noeuds et de batiments comparés et les
+        batiments rangés par zone.
+        """
+        if self.store:
+            selected = set()
+            for cell in self.cells_of(lat_min, lat_max, lon_min, lon_max):
+                for i_bat in self.cells.get(cell, ()):
+                    bat_lat_min, bat_lat_max, bat_lon_min, bat_lon_max = self.bounds[i_bat]
+                    if (bat_lat_max >= lat_min and bat_lat_min <= lat_max and
+                            bat_lon_max >= lon_min and bat_lon_min <= lon_max):
+                        selected.add(i_bat)
+            buildings = [self.buildings[i_bat] for i_bat in sorted(selected)]
+            nodes_count = len({point.node_id for batiment in buildings for point in batiment.nodes})
+        else:
+            buildings = self.buildings
+            nodes_count = self.nodes_count
+        bati = {}
+        for batiment in buildings:
+            batiment.reset_matching()
+            zone = zone_of(batiment.center, lat_min, lon_min, delta_lat, delta_lon, nb_zone)
+            bati.setdefault(zone, []).append(batiment)
+        return nodes_count, len(buildings), bati
+
+
+def compare(osm_file_current: str, osm_file_future: str, file_prefix: str, base_path: str,
+            store: bool = False, skip_unused_nodes: bool = False, stats_only: bool = False, jobs: int = 1,
+            memory_limit: float = None, debug: bool = False,
+            split_count: int = None, split_tile: float = None, spatial_order: str = "none",
+            dense_density: bool = False,
+            borne_inf: float = BORNE_INF_MODIF, borne_sup: float = BORNE_SUP_MODIF,
+            current=None):
+    """Comparaison du bâti actuel (osm_file_current) et du cadastre
+    (osm_file_future) et écriture des fichiers résultats dans base_path.
+
+    Les paramètres reprennent les options de la ligne de commande
+    (memory_limit en Mo, split_tile en degrés). Si current (CurrentBuildings) est fourni, le bâti
+    actuel déjà chargé est utilisé au lieu de lire osm_file_current.
+
+    Retourne le résumé de la comparaison (celui enregistré dans
+    prefix_stats.json avec stats_only) complété par la liste des fichiers
+    écrits.
+    """
+    log = logging.getLogger("main")
     separation = "--------------------------------------------------------------------------------------------------------------------------------"
 
     tps1 = time.perf_counter()
@@ -368,6 +1554,18 @@ def main():
     log.info("-                    Lecture des données                         -")
     log.info("------------------------------------------------------------------")
 
+    work_dir = None
+    if memory_limit and current is None:
+        # les fichiers sont indexés dans des bases temporaires et les
+        # batiments sont rangés sur disque par ligne de zones
+        memory_limit = int(memory_limit * 1024 * 1024)
+        work_dir = tempfile.TemporaryDirectory(prefix="BatiOsm_")
+        if skip_unused_nodes:
+            log.warning("--skip-unused-nodes est sans effet avec --memory-limit")
+            skip_unused_nodes = False
+    if jobs > 1 and not stats_only and export_jobs(jobs) == 1:
+        log.warning("--jobs est sans effet : un seul processeur, ou fork indisponible")
+
     # ------------------------------------------------------------------------
     # lecture des nouveaux batiments :
     # ------------------------------------------------------------------------
@@ -378,207 +1576,115 @@ def main():
     lon_min = 45.0
     lon_max = -45.0
 
-    new_nodes = []
-    new_id_nodes = []
-
-    future_nodes_count = 0
-    future_ways_count = 0
-
-    utf8_xml_parser = lxml.etree.XMLParser(encoding="utf-8")
-    new_bati_etree = lxml.etree.parse(osm_file_future, parser=utf8_xml_parser)
-    new_bati_root = new_bati_etree.getroot()
-
-    # lecture des noeuds
-    for point in new_bati_root.iter("node"):
-        attributes = []
-        node_id = point.get("id")
-        node_lat = float(point.get("lat"))
-        node_lon = float(point.get("lon"))
-        if node_lat < lat_min:
-            lat_min = node_lat
-        if node_lat > lat_max:
-            lat_max = node_lat
-        if node_lon < lon_min:
-            lon_min = node_lon
-        if node_lon > lon_max:
-            lon_max = node_lon
-        new_id_nodes.append(node_id)
-        new_nodes.append(Point(node_id, node_lat, node_lon))
-        info_nodes = point.attrib
-        for i_key in range(len(info_nodes)):
-            attributes.append(info_nodes.keys()[i_key])
-            attributes.append(info_nodes.get(info_nodes.keys()[i_key]))
-        new_nodes[future_nodes_count].set_history(attributes)
-        future_nodes_count = future_nodes_count + 1
-
-    nb_zone_lat = int((lat_max - lat_min) * (math.pi / 180 * EARTH_RADIUS) / (2 * BORNE_SUP_MODIF)) - 1
-    nb_zone_lon = int((lon_max - lon_min) * (math.pi / 180 * EARTH_RADIUS) / (2 * BORNE_SUP_MODIF)) - 1
+    if work_dir is not None:
+        future_store = os.path.join(work_dir.name, "future.sqlite")
+        ingest_osm_files(future_store, [osm_file_future])
+        future_connection = open_store(future_store)
+        future_skipped_count = 0
+        node_lat_min, node_lat_max, node_lon_min, node_lon_max, future_nodes_count = future_connection.execute(
+            "SELECT min(lat), max(lat), min(lon), max(lon), count(*) FROM node").fetchone()
+        if future_nodes_count:
+            lat_min = min(lat_min, node_lat_min)
+            lat_max = max(lat_max, node_lat_max)
+            lon_min = min(lon_min, node_lon_min)
+            lon_max = max(lon_max, node_lon_max)
+    else:
+        new_nodes, new_ways, future_skipped_count = read_osm_file(osm_file_future, skip_unused_nodes)
+        future_nodes_count = len(new_nodes)
+
+        for point in new_nodes.values():
+            if point.lat < lat_min:
+                lat_min = point.lat
+            if point.lat > lat_max:
+                lat_max = point.lat
+            if point.lon < lon_min:
+                lon_min = point.lon
+            if point.lon > lon_max:
+                lon_max = point.lon
+        del new_nodes
+
+    nb_zone_lat = int((lat_max - lat_min) * (math.pi / 180 * EARTH_RADIUS) / (2 * borne_sup)) - 1
+    nb_zone_lon = int((lon_max - lon_min) * (math.pi / 180 * EARTH_RADIUS) / (2 * borne_sup)) - 1
     nb_zone = min(nb_zone_lat, nb_zone_lon, 500, NB_ZONE_USER)
     delta_lat = (lat_max - lat_min) / nb_zone
     delta_lon = (lon_max - lon_min) / nb_zone
 
-    new_bati = []
-    for i in range(nb_zone):
-        new_bati += [[]]
-        for j in range(nb_zone):
-            new_bati[i] += [[]]
-
-    # lectures des batiments
-    for way in new_bati_root.iter("way"):
-        tab_nodes = []
-        tab_key = []
-        tab_value = []
-        way_id = way.get("id")
-        nbre_node = len(way.findall("./nd"))
-        nbre_tag = len(way.findall("./tag"))
-        for point in way.findall("./nd"):
-            id_node = point.get("ref")
-            tab_nodes.append(new_nodes[new_id_nodes.index(id_node)])
-        for tag in way.findall("./tag"):
-            tab_key.append(tag.get("k"))
-            tab_value.append(tag.get("v"))
-        batiment_lu = Building(
-            way_id, nbre_node, tab_nodes, nbre_tag, tab_key, tab_value, 1000, 0.0, "UNKNOWN"
-        )
-        batiment_lu.compute_center()
-        if batiment_lu.area_issue == "YES":
-            log.info(f"  Attention, surface nulle obtenue pour le batiment :{batiment_lu.bat_id}")
-        batiment_lu.compute_width()
-        batiment_lu.set_history([])
-        batiment_lu.set_close_building("")
-        repere_latitude = int((batiment_lu.center.lat - lat_min) / delta_lat)
-        repere_longitude = int((batiment_lu.center.lon - lon_min) / delta_lon)
-        if repere_latitude > nb_zone - 1:
-            repere_latitude = nb_zone - 1
-        if repere_longitude > nb_zone - 1:
-            repere_longitude = nb_zone - 1
-        if repere_latitude < 0:
-            repere_latitude = 0
-        if repere_longitude < 0:
-            repere_longitude = 0
-        new_bati[repere_latitude][repere_longitude].append(batiment_lu)
-        future_ways_count = future_ways_count + 1
-
-    # lectures des relations
-    outer_way = ""
-    for relation in new_bati_root.iter("relation"):
-        id_relation = relation.get("id")
-        for member in relation.findall("./member"):
-            id_membre = member.get("ref")
-            role = member.get("role")
-            for i_lat in range(nb_zone):
-                for i_lon in range(nb_zone):
-                    for i_bat in range(len(new_bati[i_lat][i_lon])):
-                        if new_bati[i_lat][i_lon][i_bat].bat_id == id_membre:
-                            if role == "outer":
-                                outer_way = new_bati[i_lat][i_lon][i_bat]
-                                outer_way.add_relation(id_relation)
-                                outer_way.multipolygone = "yes"
-                            else:
-                                new_bati[i_lat][i_lon][i_bat].set_role("inner")
-                                outer_way.addInner(new_bati[i_lat][i_lon][i_bat])
+    # l'historique des chemins du cadastre n'est pas conservé
+    if work_dir is not None:
+        new_spill = ZoneSpill(work_dir.name, "future", memory_limit // 4)
+        future_ways_count = spill_buildings(
+            new_spill, iter_store_ways(future_connection, order="way.relation, way.id"), False,
+            lat_min, lon_min, delta_lat, delta_lon, nb_zone)
+        future_connection.close()
+    else:
+        # seules les zones occupées sont stockées : (i_lat, i_lon) -> batiments
+        new_bati = {}
+        future_ways_count = place_buildings(
+            new_bati, new_ways, False, lat_min, lon_min, delta_lat, delta_lon, nb_zone)
+        del new_ways
 
     log.info(f"  {future_nodes_count} noeuds répertoriés dans le fichier {osm_file_future}")
+    if skip_unused_nodes:
+        log.info(f"  {future_skipped_count} noeuds non utilisés par les batiments ignorés")
     log.info(f"  {future_ways_count} batiments répertoriés dans le fichier {osm_file_future}")
 
     # ------------------------------------------------------------------------
     # lecture des vieux batiments :
     # ------------------------------------------------------------------------
-    log.info(f"lecture du fichier {osm_file_current}...")
-
-    current_nodes = []
-    current_nodes_ids = []
-
-    current_nodes_count = 0
-    current_ways_count = 0
-
-    utf8_xml_parser = lxml.etree.XMLParser(encoding="utf-8")
-
-    old_bati_etree = lxml.etree.parse(osm_file_current, parser=utf8_xml_parser)
-    old_bati_root = old_bati_etree.getroot()
-
-    # lecture des noeuds
-    for point in old_bati_root.iter("node"):
-        attributes = []
-        node_id = point.get("id")
-        node_lat = point.get("lat")
-        node_lon = point.get("lon")
-        current_nodes_ids.append(node_id)
-        current_nodes.append(Point(node_id, node_lat, node_lon))
-        info_nodes = point.attrib
-        for i_key in range(len(info_nodes)):
-            attributes.append(info_nodes.keys()[i_key])
-            attributes.append(info_nodes.get(info_nodes.keys()[i_key]))
-        current_nodes[current_nodes_count].set_history(attributes)
-        current_nodes_count = current_nodes_count + 1
-
-    old_bati = []
-    for i in range(nb_zone):
-        old_bati += [[]]
-        for j in range(nb_zone):
-            old_bati[i] += [[]]
-
-    # lectures des batiments
-    for way in old_bati_root.iter("way"):
-        attributes = []
-        tab_nodes = []
-        tab_key = []
-        tab_value = []
-        way_id = way.get("id")
-        info_way = way.attrib
-        nbre_node = len(way.findall("./nd"))
-        nbre_tag = len(way.findall("./tag"))
-        for point in way.findall("./nd"):
-            id_node = point.get("ref")
-            tab_nodes.append(current_nodes[current_nodes_ids.index(id_node)])
-        for tag in way.findall("./tag"):
-            tab_key.append(tag.get("k"))
-            tab_value.append(tag.get("v"))
-        for i_key in range(len(info_way)):
-            attributes.append(info_way.keys()[i_key])
-            attributes.append(info_way.get(info_way.keys()[i_key]))
-        batiment_lu = Building(
-            way_id, nbre_node, tab_nodes, nbre_tag, tab_key, tab_value, 1000, 0.0, "UNKNOWN"
-        )
-        batiment_lu.compute_center()
-        if batiment_lu.area_issue == "YES":
-            log.info(f"  Attention, surface nulle obtenue pour le batiment :{batiment_lu.bat_id}")
-        batiment_lu.compute_width()
-        batiment_lu.set_history(attributes)
-        batiment_lu.set_close_building("")
-        repere_latitude = int((batiment_lu.center.lat - lat_min) / delta_lat)
-        repere_longitude = int((batiment_lu.center.lon - lon_min) / delta_lon)
-        if repere_latitude > nb_zone - 1:
-            repere_latitude = nb_zone - 1
-        if repere_longitude > nb_zone - 1:
-            repere_longitude = nb_zone - 1
-        if repere_latitude < 0:
-            repere_latitude = 0
-        if repere_longitude < 0:
-            repere_longitude = 0
-        old_bati[repere_latitude][repere_longitude].append(batiment_lu)
-        current_ways_count = current_ways_count + 1
-
-    # lectures des relations
-    for relation in old_bati_root.iter("relation"):
-        id_relation = relation.get("id")
-        for member in relation.findall("./member"):
-            id_membre = member.get("ref")
-            role = member.get("role")
-            for i_lat in range(nb_zone):
-                for i_lon in range(nb_zone):
-                    for i_bat in range(len(old_bati[i_lat][i_lon])):
-                        if old_bati[i_lat][i_lon][i_bat].bat_id == id_membre:
-                            if role == "outer":
-                                outer_way = old_bati[i_lat][i_lon][i_bat]
-                                outer_way.add_relation(id_relation)
-                                outer_way.multipolygone = "yes"
-                            else:
-                                old_bati[i_lat][i_lon][i_bat].set_role("inner")
-                                outer_way.addInner(old_bati[i_lat][i_lon][i_bat])
+    current_skipped_count = 0
+    if work_dir is not None:
+        if store:
+            log.info(f"lecture de la base {osm_file_current}...")
+            if not os.path.exists(osm_file_current):
+                raise FileNotFoundError(osm_file_current)
+            current_connection = open_store(osm_file_current)
+            bbox = (lat_min, lat_max, lon_min, lon_max)
+            current_nodes_count = current_connection.execute(
+                "SELECT count(DISTINCT ref.value) FROM way_rtree JOIN way ON way.id = way_rtree.id,"
+                " json_each(way.nodes) AS ref"
+                " WHERE way_rtree.max_lat >= ? AND way_rtree.min_lat <= ?"
+                " AND way_rtree.max_lon >= ? AND way_rtree.min_lon <= ?", bbox).fetchone()[0]
+        else:
+            log.info(f"lecture du fichier {osm_file_current}...")
+            current_store = os.path.join(work_dir.name, "current.sqlite")
+            ingest_osm_files(current_store, [osm_file_current])
+            current_connection = open_store(current_store)
+            bbox = None
+            current_nodes_count = current_connection.execute("SELECT count(*) FROM node").fetchone()[0]
+        old_spill = ZoneSpill(work_dir.name, "current", memory_limit // 4)
+        current_ways_count = spill_buildings(
+            old_spill, iter_store_ways(current_connection, bbox, order="way.relation, way.id"), True,
+            lat_min, lon_min, delta_lat, delta_lon, nb_zone)
+        current_connection.close()
+    elif current is not None:
+        # le bâti actuel a déjà été lu (voir serve_main) : il est seulement
+        # rangé dans les zones de ce cadastre
+        log.info(f"bâti actuel déjà chargé depuis {osm_file_current}")
+        current_skipped_count = current.skipped_count
+        current_nodes_count, current_ways_count, old_bati = current.place(
+            lat_min, lat_max, lon_min, lon_max, delta_lat, delta_lon, nb_zone)
+    else:
+        if store:
+            # le bâti actuel est lu dans une base créée par la commande ingest,
+            # limité aux batiments qui intersectent l'emprise du cadastre
+            log.info(f"lecture de la base {osm_file_current}...")
+            current_nodes_count, old_ways = read_store(osm_file_current, lat_min, lat_max, lon_min, lon_max)
+        else:
+            log.info(f"lecture du fichier {osm_file_current}...")
+            current_nodes, old_ways, current_skipped_count = read_osm_file(
+                osm_file_current, skip_unused_nodes)
+            current_nodes_count = len(current_nodes)
+            del current_nodes
+
+        old_bati = {}
+        current_ways_count = place_buildings(
+            old_bati, old_ways, True, lat_min, lon_min, delta_lat, delta_lon, nb_zone)
+        del old_ways
 
     tps2 = time.perf_counter()
     log.info(f' {current_nodes_count} noeuds répertoriés dans le fichier {osm_file_current}')
+    if skip_unused_nodes:
+        log.info(f' {current_skipped_count} noeuds non utilisés par les batiments ignorés')
     log.info(f' {current_ways_count} batiments répertoriés dans le fichier {osm_file_current}')
 
     log.info("------------------------------------------------------------------")
@@ -587,193 +1693,88 @@ def main():
     log.info("-  Recherche des similitudes et des différences entre batiments  -")
     log.info(f'-  NB_ZONE a été calculé à : {nb_zone}')
     log.info("------------------------------------------------------------------")
-    # ------------------------------------------------------------------------------
-    # calcul des distances mini entre chaque anciens batiments
-    # pour chaque batiment anciens (resp. nouveau) on détermine la distance
-    # la plus petite avec tous les nouveaux batiments (resp. anciens)
-    # ------------------------------------------------------------------------------
-    #
 
-    nb_bat_traite = 0
+    if work_dir is not None:
+        windows = iter_windows(old_spill, new_spill, nb_zone, memory_limit)
+    else:
+        # toute la grille est traitée en une seule bande
+        windows = [(old_bati, new_bati, 0, nb_zone)]
+
+    results = None
+    if not stats_only:
+        results = ResultFiles(base_path, file_prefix, jobs, split_count, split_tile,
+                              spatial_order, (lat_min, lat_max, lon_min, lon_max))
+    file_debug = None
+    if debug:
+        file_debug = open_debug_file(os.path.join(base_path, file_prefix + "_debug.osm"),
+                                     lat_min, lat_max, lon_min, lon_max, delta_lat, delta_lon, nb_zone)
+
+    status_count = {"IDENTIQUE": 0, "MODIFIE": 0, "NOUVEAU": 0, "SUPPRIME": 0}
+    balance_errors = []
+    # nombre d'anciens et de nouveaux batiments et de comparaisons des zones
+    # occupées
+    density = {}
     nb_comparaison = 0
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            lat_inf = max(i_lat - 1, 0)
-            lon_inf = max(i_lon - 1, 0)
-            lat_sup = min(i_lat + 1, nb_zone - 1) + 1
-            lon_sup = min(i_lon + 1, nb_zone - 1) + 1
-            for i_bat in range(len(old_bati[i_lat][i_lon])):
-                if old_bati[i_lat][i_lon][i_bat].role == "outer":
-                    nb_bat_traite = nb_bat_traite + 1
-                    avancement = float(nb_bat_traite) / (current_ways_count + future_ways_count) * 100.0
-                    sys.stdout.write(f'Calcul en cours : {int(avancement)} % {chr(13)}')
-                    for n_lat in range(lat_inf, lat_sup):
-                        for n_lon in range(lon_inf, lon_sup):
-                            for n_bat in range(len(new_bati[n_lat][n_lon])):
-                                if new_bati[n_lat][n_lon][n_bat].role == "outer":
-                                    distance = old_bati[i_lat][i_lon][
-                                        i_bat
-                                    ].center.distance(new_bati[n_lat][n_lon][n_bat].center)
-                                    nb_comparaison = nb_comparaison + 1
-                                    if old_bati[i_lat][i_lon][i_bat].min_distance > distance:
-                                        old_bati[i_lat][i_lon][i_bat].set_min_distance(distance)
-                                        old_bati[i_lat][i_lon][i_bat].set_close_building(
-                                            new_bati[n_lat][n_lon][n_bat].bat_id
-                                        )
-
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            lat_inf = max(i_lat - 1, 0)
-            lon_inf = max(i_lon - 1, 0)
-            lat_sup = min(i_lat + 1, nb_zone - 1) + 1
-            lon_sup = min(i_lon + 1, nb_zone - 1) + 1
-            for i_bat in range(len(new_bati[i_lat][i_lon])):
-                if new_bati[i_lat][i_lon][i_bat].role == "outer":
-                    nb_bat_traite = nb_bat_traite + 1
-                    avancement = (
-                            float(nb_bat_traite) / (current_ways_count + future_ways_count) * 100.0
-                    )
-                    sys.stdout.write(f'Calcul en cours : {int(avancement)} % {chr(13)}')
-                    for o_lat in range(lat_inf, lat_sup):
-                        for o_lon in range(lon_inf, lon_sup):
-                            for o_bat in range(len(old_bati[o_lat][o_lon])):
-                                if old_bati[o_lat][o_lon][o_bat].role == "outer":
-                                    distance = new_bati[i_lat][i_lon][
-                                        i_bat
-                                    ].center.distance(old_bati[o_lat][o_lon][o_bat].center)
-                                    nb_comparaison = nb_comparaison + 1
-                                    if new_bati[i_lat][i_lon][i_bat].min_distance > distance:
-                                        new_bati[i_lat][i_lon][i_bat].set_min_distance(distance)
-                                        new_bati[i_lat][i_lon][i_bat].set_close_building(
-                                            old_bati[o_lat][o_lon][o_bat].bat_id
-                                        )
-                                        if distance < BORNE_INF_MODIF:
-                                            new_bati[i_lat][i_lon][i_bat].copy_tag(
-                                                old_bati[o_lat][o_lon][o_bat], "IDENTIQUE"
-                                            )
-                                        elif (
-                                                BORNE_INF_MODIF < distance < BORNE_SUP_MODIF
-                                        ):
-                                            new_bati[i_lat][i_lon][i_bat].copy_tag(
-                                                old_bati[o_lat][o_lon][o_bat], "MODIFIE"
-                                            )
-    # ------------------------------------------------------------------------
-    # Classement des batiments :
-    #  - dist_mini < BORNE_INF_MODIF : identique
-    #  - BORNE_INF_MODIF < dist_mini < BORNE_SUP_MODIF : modifié
-    #  - dist_mini > BORNE_SUP_MODIF : nouveau ou supprimé
-    #  - dist_mini > largeur : nouveau ou supprimé
-    # ------------------------------------------------------------------------
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            # Classement des anciens batiments
-            for i_bat in range(len(old_bati[i_lat][i_lon])):
-                if old_bati[i_lat][i_lon][i_bat].role == "outer":
-                    if old_bati[i_lat][i_lon][i_bat].min_distance > BORNE_SUP_MODIF:
-                        old_bati[i_lat][i_lon][i_bat].set_status("SUPPRIME")
-                    if (
-                            old_bati[i_lat][i_lon][i_bat].min_distance
-                            > old_bati[i_lat][i_lon][i_bat].width
-                    ):
-                        old_bati[i_lat][i_lon][i_bat].set_status("SUPPRIME")
-            # Classement des nouveaux batiments
-            for i_bat in range(len(new_bati[i_lat][i_lon])):
-                if new_bati[i_lat][i_lon][i_bat].role == "outer":
-                    if new_bati[i_lat][i_lon][i_bat].min_distance < BORNE_INF_MODIF:
-                        new_bati[i_lat][i_lon][i_bat].set_status("IDENTIQUE")
-                    elif (
-                            BORNE_INF_MODIF < new_bati[i_lat][i_lon][i_bat].min_distance < BORNE_SUP_MODIF
-                    ):
-                        new_bati[i_lat][i_lon][i_bat].set_status("MODIFIE")
-                    elif new_bati[i_lat][i_lon][i_bat].min_distance > BORNE_SUP_MODIF:
-                        new_bati[i_lat][i_lon][i_bat].set_status("NOUVEAU")
-                    if (
-                            new_bati[i_lat][i_lon][i_bat].min_distance
-                            > new_bati[i_lat][i_lon][i_bat].width
-                    ):
-                        new_bati[i_lat][i_lon][i_bat].set_status("NOUVEAU")
-
-    nb_bat_new = 0
-    nb_bat_mod = 0
-    nb_bat_del = 0
-    nb_bat_no_mod = 0
-
-    # Comptage des batiment de chaque catégorie.
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            for i_bat in range(len(old_bati[i_lat][i_lon])):
-                if old_bati[i_lat][i_lon][i_bat].role == "outer":
-                    if old_bati[i_lat][i_lon][i_bat].status == "SUPPRIME":
-                        nb_bat_del = nb_bat_del + 1
-            for i_bat in range(len(new_bati[i_lat][i_lon])):
-                if new_bati[i_lat][i_lon][i_bat].role == "outer":
-                    if new_bati[i_lat][i_lon][i_bat].status == "IDENTIQUE":
-                        nb_bat_no_mod = nb_bat_no_mod + 1
-                    elif new_bati[i_lat][i_lon][i_bat].status == "MODIFIE":
-                        nb_bat_mod = nb_bat_mod + 1
-                    elif new_bati[i_lat][i_lon][i_bat].status == "NOUVEAU":
-                        nb_bat_new = nb_bat_new + 1
-
-    # Vérification de la cohérence des résultats. On chercher à vérifier que :
-    # nb_bat_apres = nb_bat_avant + nouveaux - supprimés
-    # si l'équation n'est pas vérifié et que la zone compte des batiments modifiés
-    # suffisant pour rétablir l'équilibre, alors on déclare les batiments modifiés
-    # comme nouveaux sinon on affiche un warning
-    warning_equilibre = ["Erreur d'équilibre : nb_bat_apres <> nb_bat_avant + nouveaux - supprimés"]
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            nb_nouveaux = 0
-            nb_supprimes = 0
-            nb_modifies = 0
-            nb_identiques = 0
-            nb_innner = 0
-            nb_bat_apres = len(new_bati[i_lat][i_lon])
-            nb_bat_avant = len(old_bati[i_lat][i_lon])
-            for i_bat in range(len(old_bati[i_lat][i_lon])):
-                if old_bati[i_lat][i_lon][i_bat].status == "SUPPRIME":
-                    nb_supprimes = nb_supprimes + 1
-            for i_bat in range(len(new_bati[i_lat][i_lon])):
-                if new_bati[i_lat][i_lon][i_bat].status == "NOUVEAU":
-                    nb_nouveaux = nb_nouveaux + 1
-                elif new_bati[i_lat][i_lon][i_bat].status == "MODIFIE":
-                    nb_modifies = nb_modifies + 1
-                elif new_bati[i_lat][i_lon][i_bat].status == "IDENTIQUE":
-                    nb_identiques = nb_identiques + 1
-                elif new_bati[i_lat][i_lon][i_bat].role == "inner":
-                    nb_innner = nb_innner + 1
-            if nb_bat_apres != nb_bat_avant + nb_nouveaux - nb_supprimes:
-                if nb_bat_apres == nb_bat_avant + nb_nouveaux + nb_modifies - nb_supprimes:
-                    for i_bat in range(len(new_bati[i_lat][i_lon])):
-                        if new_bati[i_lat][i_lon][i_bat].status == "MODIFIE":
-                            new_bati[i_lat][i_lon][i_bat].set_status("NOUVEAU")
-                else:
-                    warning_equilibre.append(f"Erreur d'équilibre pour la zone i_lat / i_lon {i_lat}/{i_lon}")
-                    warning_equilibre.append(
-                        f"   Avant : {nb_bat_avant}   Après : {nb_bat_apres}   Nouveaux : {nb_nouveaux}   Supprimés : {nb_supprimes}   Modifiés : {nb_modifies}")
-
-    nb_bat_new = 0
-    nb_bat_mod = 0
-    nb_bat_del = 0
-    nb_bat_no_mod = 0
+    compute_time = 0.0
+    export_time = 0.0
+    for old_window, new_window, row_inf, row_sup in windows:
+        tps_window = time.perf_counter()
+        log.debug(f"traitement des lignes de zones {row_inf} à {row_sup - 1}")
+        # ------------------------------------------------------------------------------
+        # calcul des distances mini entre chaque anciens batiments
+        # pour chaque batiment anciens (resp. nouveau) on détermine la distance
+        # la plus petite avec tous les nouveaux batiments (resp. anciens)
+        # ------------------------------------------------------------------------------
+        zone_comparisons = {}
+        match_zones(old_window, new_window, nb_zone, borne_inf, borne_sup, zone_comparisons)
+
+        # Classement, vérification de l'équilibre et comptage en une seule
+        # passe sur les zones occupées de la bande (hors lignes voisines).
+        old_bati = {zone: bati for zone, bati in old_window.items() if row_inf <= zone[0] < row_sup}
+        new_bati = {zone: bati for zone, bati in new_window.items() if row_inf <= zone[0] < row_sup}
+        del old_window, new_window
+        window_count, window_errors = classify_zones(old_bati, new_bati, borne_inf, borne_sup)
+        for status in status_count:
+            status_count[status] = status_count[status] + window_count[status]
+        balance_errors.extend(window_errors)
+        # seules les comparaisons des zones de la bande sont comptées : celles
+        # des lignes voisines le sont avec leur propre bande
+        for zone in old_bati.keys() | new_bati.keys():
+            density[zone] = (len(old_bati.get(zone, [])), len(new_bati.get(zone, [])),
+                             zone_comparisons.get(zone, 0))
+            nb_comparaison = nb_comparaison + zone_comparisons.get(zone, 0)
+
+        tps_export = time.perf_counter()
+        compute_time = compute_time + tps_export - tps_window
+        if results is not None:
+            # Ecriture des fichiers osm : les batiments de chaque catégorie
+            # sont sérialisés par paquets (en parallèle avec --jobs) puis
+            # écrits dans l'ordre des zones.
+            results.write(old_bati, new_bati)
+            export_time = export_time + time.perf_counter() - tps_export
+        if file_debug is not None:
+            # Transcription des points au cdg des batiments
+            for zone in sorted(new_bati):
+                for batiment in new_bati[zone]:
+                    batiment.center.to_xml()
+                    file_debug.write(f'{batiment.center.print_node}\n')
+        del old_bati, new_bati
+    if work_dir is not None:
+        work_dir.cleanup()
+    if file_debug is not None:
+        file_debug.write("</osm>\n")
+        file_debug.close()
 
-    # Comptage des batiment de chaque catégorie.
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            for i_bat in range(len(old_bati[i_lat][i_lon])):
-                if old_bati[i_lat][i_lon][i_bat].role == "outer":
-                    if old_bati[i_lat][i_lon][i_bat].status == "SUPPRIME":
-                        nb_bat_del = nb_bat_del + 1
-            for i_bat in range(len(new_bati[i_lat][i_lon])):
-                if new_bati[i_lat][i_lon][i_bat].role == "outer":
-                    if new_bati[i_lat][i_lon][i_bat].status == "IDENTIQUE":
-                        nb_bat_no_mod = nb_bat_no_mod + 1
-                    elif new_bati[i_lat][i_lon][i_bat].status == "MODIFIE":
-                        nb_bat_mod = nb_bat_mod + 1
-                    elif new_bati[i_lat][i_lon][i_bat].status == "NOUVEAU":
-                        nb_bat_new = nb_bat_new + 1
+    nb_bat_no_mod = status_count["IDENTIQUE"]
+    nb_bat_mod = status_count["MODIFIE"]
+    nb_bat_new = status_count["NOUVEAU"]
+    nb_bat_del = status_count["SUPPRIME"]
 
     log.info("------------------------------------------------------------------")
-    log.info("-                    Création des fichiers                       -")
+    if stats_only:
+        log.info("-                 Statistiques de la comparaison                 -")
+    else:
+        log.info("-                    Création des fichiers                       -")
     log.info("------------------------------------------------------------------")
     log.info(f"{nb_comparaison} comparaisons entre batiments effectuées")
     log.info(f"{nb_bat_no_mod} batiments identiques")
@@ -781,18 +1782,62 @@ def main():
     log.info(f"{nb_bat_new} batiments nouveaux")
     log.info(f"{nb_bat_del} batiments supprimés")
 
-    tps3 = time.perf_counter()
+    # résumé de la comparaison, enregistré dans prefix_stats.json avec
+    # stats_only et retourné dans tous les cas
+    stats = {
+        "input": {
+            "current": osm_file_current,
+            "future": osm_file_future,
+            "borne_inf_modif": borne_inf,
+            "borne_sup_modif": borne_sup,
+            "nb_zone": nb_zone,
+        },
+        "current": {"nodes": current_nodes_count, "buildings": current_ways_count},
+        "future": {"nodes": future_nodes_count, "buildings": future_ways_count},
+        "result": {
+            "comparisons": nb_comparaison,
+            "identical": nb_bat_no_mod,
+            "modified": nb_bat_mod,
+            "new": nb_bat_new,
+            "deleted": nb_bat_del,
+        },
+        "balance_errors": [
+            {"zone": list(zone), "before": avant, "after": apres, "new": nouveaux,
+             "deleted": supprimes, "modified": modifies}
+            for zone, avant, apres, nouveaux, supprimes, modifies in balance_errors
+        ],
+    }
+
+    if stats_only:
+        # seuls les comptages et les temps sont enregistrés, aucun batiment
+        # n'est exporté
+        stats["times"] = {"read": tps2 - tps1, "compute": compute_time, "total": time.perf_counter() - tps1}
+        stats_file_name = os.path.join(base_path, f"{file_prefix}_stats.json")
+        with open(stats_file_name, "w", encoding="utf-8") as stats_file:
+            json.dump(stats, stats_file, ensure_ascii=False, indent=2)
+            stats_file.write("\n")
+        log.info(f"Statistiques enregistrées dans {stats_file_name}")
+        log.info(f"Durée totale : {stats['times']['total']}")
+        return dict(stats, files=[stats_file_name])
+
+    results.close()
+
+    tps4 = time.perf_counter()
 
     file_log = open(os.path.join(base_path, f'{file_prefix}_log.txt'), "w")
     file_log.write("Rappel des input : \n")
-    file_log.write(f"    BORNE_INF_MODIF : {BORNE_INF_MODIF}\n")
-    file_log.write(f"    BORNE_SUP_MODIF : {BORNE_SUP_MODIF}\n")
+    file_log.write(f"    BORNE_INF_MODIF : {borne_inf}\n")
+    file_log.write(f"    BORNE_SUP_MODIF : {borne_sup}\n")
     file_log.write(f"    NB_ZONE : {nb_zone}\n")
     file_log.write(f"Le fichier {osm_file_current} contient :\n")
     file_log.write(f"    - {current_nodes_count} noeuds\n")
+    if skip_unused_nodes:
+        file_log.write(f"    - {current_skipped_count} noeuds ignorés (non utilisés par les batiments)\n")
     file_log.write(f"    - {current_ways_count} batiments\n")
     file_log.write(f"Le fichier {osm_file_future} contient :\n")
     file_log.write(f"    - {future_nodes_count} noeuds\n")
+    if skip_unused_nodes:
+        file_log.write(f"    - {future_skipped_count} noeuds ignorés (non utilisés par les batiments)\n")
     file_log.write(f"    - {future_ways_count} batiments\n")
     file_log.write("Résultat de la comparaison :\n")
     file_log.write(f"    Nombre de comparaisons effectuées : {nb_comparaison}\n")
@@ -802,220 +1847,299 @@ def main():
     file_log.write(f"    Nombre de batiments supprimés trouvés : {nb_bat_del}\n")
     file_log.write(f"Temps de lecture des fichiers : {tps2 - tps1} secondes.\n"
                    )
-    file_log.write(f"Temps de calcul : {tps3 - tps2} secondes.\n")
-    file_log.write(f"Temps d'execution totale : {tps3 - tps1} secondes.\n")
+    file_log.write(f"Temps de calcul : {compute_time} secondes.\n")
+    file_log.write(f"Temps d'export : {export_time} secondes.\n")
+    file_log.write(f"Temps d'execution totale : {tps4 - tps1} secondes.\n")
     file_log.write(f"{separation}\n")
 
-    for i_warn in range(len(warning_equilibre)):
-        file_log.write(f"{warning_equilibre[i_warn]}\n")
+    file_log.write("Erreur d'équilibre : nb_bat_apres <> nb_bat_avant + nouveaux - supprimés\n")
+    for (i_lat, i_lon), avant, apres, nouveaux, supprimes, modifies in balance_errors:
+        file_log.write(f"Erreur d'équilibre pour la zone i_lat / i_lon {i_lat}/{i_lon}\n")
+        file_log.write(
+            f"   Avant : {avant}   Après : {apres}   Nouveaux : {nouveaux}   Supprimés : {supprimes}   Modifiés : {modifies}\n")
     file_log.write(f"{separation}\n")
     file_log.write(f"Récapitulatif des batiments issus de {osm_file_future}\n")
     file_log.write(f"{separation}\n")
-
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            for i_bat in range(len(new_bati[i_lat][i_lon])):
-                resultat = [
-                    new_bati[i_lat][i_lon][i_bat].bat_id,
-                    new_bati[i_lat][i_lon][i_bat].status,
-                    str(round(new_bati[i_lat][i_lon][i_bat].min_distance, 9)),
-                    str(round(new_bati[i_lat][i_lon][i_bat].center.lat, 7)),
-                    str(round(new_bati[i_lat][i_lon][i_bat].center.lon, 7)),
-                    str(round(new_bati[i_lat][i_lon][i_bat].area, 1)),
-                ]
-                file_log.write(log_format(resultat, 16, "|") + "\n")
+    results.copy_section("recap_new", file_log)
     file_log.write(f"{separation}\n")
     file_log.write(f"Récapitulatif des batiments issus de {osm_file_current}\n")
     file_log.write(f"{separation}\n")
-
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            for i_bat in range(len(old_bati[i_lat][i_lon])):
-                resultat = [
-                    old_bati[i_lat][i_lon][i_bat].bat_id,
-                    old_bati[i_lat][i_lon][i_bat].status,
-                    str(round(old_bati[i_lat][i_lon][i_bat].min_distance, 9)),
-                    str(round(old_bati[i_lat][i_lon][i_bat].center.lat, 7)),
-                    str(round(old_bati[i_lat][i_lon][i_bat].center.lon, 7)),
-                    str(round(old_bati[i_lat][i_lon][i_bat].area, 1)),
-                ]
-                file_log.write(log_format(resultat, 16, "|") + "\n")
+    results.copy_section("recap_old", file_log)
     file_log.write(f"{separation}\n")
 
-    nom_file_no_mod = f"{file_prefix}_unModified.osm"
-    file_no_mod = open(os.path.join(base_path, nom_file_no_mod), "w")
-    file_no_mod.write('<?xml version="1.0" encoding="UTF-8"?>' + "\n")
-    file_no_mod.write('<osm version="0.6" upload="true" generator="JOSM">' + "\n")
-
-    nom_file_mod = f"{file_prefix}_mod_1_a_{nb_bat_mod}.osm"
-    file_mod = open(os.path.join(base_path, nom_file_mod), "w")
-    file_mod.write('<?xml version="1.0" encoding="UTF-8"?>' + "\n")
-    file_mod.write('<osm version="0.6" upload="true" generator="JOSM">' + "\n")
-
-    nom_file_new = f"{file_prefix}_new_1_a_{nb_bat_new}.osm"
-    file_new = open(os.path.join(base_path, nom_file_new), "w")
-    file_new.write('<?xml version="1.0" encoding="UTF-8"?>' + "\n")
-    file_new.write('<osm version="0.6" upload="true" generator="JOSM">' + "\n")
-
-    nom_file_del = f"{file_prefix}_sup_1_a_{nb_bat_del}.osm"
-    file_del = open(os.path.join(base_path, nom_file_del), "w")
-    file_del.write('<?xml version="1.0" encoding="UTF-8"?>' + "\n")
-    file_del.write('<osm version="0.6" upload="true" generator="JOSM">' + "\n")
-
-    # Ecriture des nouveaux batiments
+    # Récapitulatif des nouveaux batiments
     headers = ["STAT", "ANCIEN BAT.", "TOL", "NOUVEAU BAT.", "fichier"]
     file_log.write("NOUVEAUX BATIMENTS" + "\n")
     file_log.write(separation + "\n")
     file_log.write(log_format(headers, 16, "|") + "\n")
     file_log.write(separation + "\n")
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            for i_bat in range(len(new_bati[i_lat][i_lon])):
-                if new_bati[i_lat][i_lon][i_bat].role == "outer":
-                    new_bati[i_lat][i_lon][i_bat].export_bat()
-                    if new_bati[i_lat][i_lon][i_bat].status == "IDENTIQUE":
-                        file_no_mod.write((new_bati[i_lat][i_lon][i_bat].print_bat + "\n"))
-                        line = [
-                            "IDENTIQUE",
-                            new_bati[i_lat][i_lon][i_bat].bat_id,
-                            str(round(new_bati[i_lat][i_lon][i_bat].min_distance, 9)),
-                            new_bati[i_lat][i_lon][i_bat].close_building_id,
-                            nom_file_no_mod,
-                        ]
-                        file_log.write(log_format(line, 16, "|") + "\n")
-                    elif new_bati[i_lat][i_lon][i_bat].status == "MODIFIE":
-                        file_mod.write((new_bati[i_lat][i_lon][i_bat].print_bat + "\n"))
-                        line = [
-                            "MODIFIE",
-                            new_bati[i_lat][i_lon][i_bat].bat_id,
-                            str(round(new_bati[i_lat][i_lon][i_bat].min_distance, 9)),
-                            new_bati[i_lat][i_lon][i_bat].close_building_id,
-                            nom_file_mod,
-                        ]
-                        file_log.write(log_format(line, 16, "|") + "\n")
-                    elif new_bati[i_lat][i_lon][i_bat].status == "NOUVEAU":
-                        file_new.write((new_bati[i_lat][i_lon][i_bat].print_bat + "\n"))
-                        line = [
-                            "NOUVEAU",
-                            new_bati[i_lat][i_lon][i_bat].bat_id,
-                            str(round(new_bati[i_lat][i_lon][i_bat].min_distance, 9)),
-                            new_bati[i_lat][i_lon][i_bat].close_building_id,
-                            nom_file_new,
-                        ]
-                        file_log.write(log_format(line, 16, "|") + "\n")
-
-    # Ecriture des anciens batiments (seulement ceux qui sont supprimés)
+    results.copy_section("new", file_log)
+
+    # Récapitulatif des anciens batiments (seulement ceux qui sont supprimés)
     headers = ["STAT", "ANCIEN BAT.", "TOL", "fichier"]
     file_log.write(separation + "\n")
     file_log.write("ANCIENS BATIMENTS" + "\n")
     file_log.write(separation + "\n")
     file_log.write(log_format(headers, 16, "|") + "\n")
     file_log.write(separation + "\n")
-    for i_lat in range(nb_zone):
-        for i_lon in range(nb_zone):
-            for i_bat in range(len(old_bati[i_lat][i_lon])):
-                if old_bati[i_lat][i_lon][i_bat].role == "outer":
-                    if old_bati[i_lat][i_lon][i_bat].status == "SUPPRIME":
-                        old_bati[i_lat][i_lon][i_bat].export_bat()
-                        file_del.write((old_bati[i_lat][i_lon][i_bat].print_bat + "\n"))
-                        line = [
-                            "SUPPRIME",
-                            old_bati[i_lat][i_lon][i_bat].bat_id,
-                            str(round(old_bati[i_lat][i_lon][i_bat].min_distance, 9)),
-                            nom_file_del,
-                        ]
-                        file_log.write(log_format(line, 16, "|") + "\n")
-    # cloture des fichiers osm
-    file_del.write("</osm>")
-    file_del.close()
-    file_no_mod.write("</osm>")
-    file_no_mod.close()
-    file_mod.write("</osm>")
-    file_mod.close()
-    file_new.write("</osm>")
-    file_new.close()
-    file_log.write(separation + "\n")
-    # Enregistrement de la 'densité' de batiments.
-    file_log.write(f"Densité de batiments issus du fichier {osm_file_current}\n")
-    file_log.write(separation + "\n")
-    headers = ["", ""]
-    i_zone = 0
-    while i_zone < nb_zone:
-        headers.append(str(i_zone))
-        i_zone = i_zone + 1
-    file_log.write(log_format(headers, 4, " ") + "\n")
-    for i_lat in range(nb_zone):
-        densite_old = [str(i_lat), "|"]
-        for i_lon in range(nb_zone):
-            densite_old.append(str(len(old_bati[i_lat][i_lon])))
-        file_log.write(log_format(densite_old, 4, " ") + "\n")
-
+    results.copy_section("old", file_log)
     file_log.write(separation + "\n")
-    file_log.write(f"Densité de batiments issus du fichier {osm_file_future}\n")
+    # Enregistrement de la 'densité' de batiments : seules les zones
+    # occupées sont listées.
+    file_log.write(f"Densité de batiments par zone occupée (anciens : {osm_file_current},"
+                   f" nouveaux : {osm_file_future})\n")
     file_log.write(separation + "\n")
-    file_log.write(log_format(headers, 4, " ") + "\n")
-    for i_lat in range(nb_zone):
-        densite_new = [str(i_lat), "|"]
-        for i_lon in range(nb_zone):
-            densite_new.append(str(len(new_bati[i_lat][i_lon])))
-        file_log.write(log_format(densite_new, 4, " ") + "\n")
-    file_log.close()
-
-    if args.debug:
-        # sauvegarde dans un fichier des zones définies
-        debug_file_name = file_prefix + "_debug.osm"
-        node_id = 100000
-        way_id = 1
-        file_debug = open(os.path.join(base_path, debug_file_name), "w")
-        file_debug.write('<?xml version="1.0" encoding="UTF-8"?>' + "\n")
-        file_debug.write('<osm version="0.6" upload="true" generator="JOSM">' + "\n")
+    file_log.write("i_lat;i_lon;lat_min;lat_max;lon_min;lon_max;anciens;nouveaux;comparaisons\n")
+    for (i_lat, i_lon), (nb_old, nb_new, nb_zone_comparaison) in sorted(density.items()):
+        file_log.write(f"{i_lat};{i_lon};"
+                       f"{round(lat_min + i_lat * delta_lat, 7)};{round(lat_min + (i_lat + 1) * delta_lat, 7)};"
+                       f"{round(lon_min + i_lon * delta_lon, 7)};{round(lon_min + (i_lon + 1) * delta_lon, 7)};"
+                       f"{nb_old};{nb_new};{nb_zone_comparaison}\n")
+
+    if dense_density:
+        # matrices complètes nb_zone x nb_zone, sur demande
+        file_log.write(separation + "\n")
+        file_log.write(f"Densité de batiments issus du fichier {osm_file_current}\n")
+        file_log.write(separation + "\n")
+        headers = ["", ""]
+        i_zone = 0
+        while i_zone < nb_zone:
+            headers.append(str(i_zone))
+            i_zone = i_zone + 1
+        file_log.write(log_format(headers, 4, " ") + "\n")
         for i_lat in range(nb_zone):
-            lat = lat_min + i_lat * delta_lat
-            node1 = f'  <node id="-{node_id}" action="modify" visible="true" lat="{lat}" lon="{lon_min}" />'
-            node2 = f'  <node id="-{node_id + 1}" action="modify" visible="true" lat="{lat}" lon="{lon_max}" />'
-            way1 = f'  <way id="-{way_id}" action="modify"' + ' visible="true">'
-            way2 = f'    <nd ref="-{node_id}" />'
-            way3 = f'    <nd ref="-{node_id + 1}" />'
-            way4 = f"  </way>"
-            file_debug.write(node1 + "\n")
-            file_debug.write(node2 + "\n")
-            file_debug.write(way1 + "\n")
-            file_debug.write(way2 + "\n")
-            file_debug.write(way3 + "\n")
-            file_debug.write(way4 + "\n")
-            node_id = node_id + 2
-            way_id = way_id + 1
-        for i_lon in range(nb_zone):
-            lon = lon_min + i_lon * delta_lon
-            node1 = f'  <node id="-{node_id}" action="modify" visible="true" lat="{lat_min}" lon="{lon}" />'
-            node2 = f'  <node id="-{node_id + 1}" action="modify" visible="true" lat="{lat_max}" lon="{lon}" />'
-            way1 = f'  <way id="-{way_id}" action="modify"' + ' visible="true">'
-            way2 = f'    <nd ref="-{node_id}" />'
-            way3 = f'    <nd ref="-{node_id + 1}" />'
-            way4 = "  </way>"
-            file_debug.write(node1 + "\n")
-            file_debug.write(node2 + "\n")
-            file_debug.write(way1 + "\n")
-            file_debug.write(way2 + "\n")
-            file_debug.write(way3 + "\n")
-            file_debug.write(way4 + "\n")
-            node_id = node_id + 2
-            way_id = way_id + 1
-        # Transcription des points au cdg des batiments
+            densite_old = [str(i_lat), "|"]
+            for i_lon in range(nb_zone):
+                densite_old.append(str(density.get((i_lat, i_lon), (0, 0, 0))[0]))
+            file_log.write(log_format(densite_old, 4, " ") + "\n")
+
+        file_log.write(separation + "\n")
+        file_log.write(f"Densité de batiments issus du fichier {osm_file_future}\n")
+        file_log.write(separation + "\n")
+        file_log.write(log_format(headers, 4, " ") + "\n")
         for i_lat in range(nb_zone):
+            densite_new = [str(i_lat), "|"]
             for i_lon in range(nb_zone):
-                for i_bat in range(len(new_bati[i_lat][i_lon])):
-                    new_bati[i_lat][i_lon][i_bat].center.to_xml()
-                    file_debug.write(f'{new_bati[i_lat][i_lon][i_bat].center.print_node}\n')
-        file_debug.write("</osm>\n")
-        file_debug.close()
+                densite_new.append(str(density.get((i_lat, i_lon), (0, 0, 0))[1]))
+            file_log.write(log_format(densite_new, 4, " ") + "\n")
+    file_log.close()
 
-    log.info(f"Durée du calcul : {tps3 - tps2}")
-    log.info(f"Durée totale : {tps3 - tps1}")
+    log.info(f"Durée du calcul : {compute_time}")
+    log.info(f"Durée de l'export : {export_time}")
+    log.info(f"Durée totale : {tps4 - tps1}")
     log.info("------------------------------------------------------------------")
     log.info("-                       FIN DU PROCESS                           -")
     log.info("------------------------------------------------------------------")
 
+    stats["times"] = {"read": tps2 - tps1, "compute": compute_time, "export": export_time, "total": tps4 - tps1}
+    files = results.files()
+    files.append(os.path.join(base_path, f'{file_prefix}_log.txt'))
+    if debug:
+        files.append(os.path.join(base_path, file_prefix + "_debug.osm"))
+    return dict(stats, files=files)
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """Serveur HTTP à l'écoute d'un socket Unix (voir serve_main)."""
+
+
+class ServeHandler(http.server.BaseHTTPRequestHandler):
+    """Requêtes acceptées par le serveur (voir serve_main), en JSON :
+
+    - GET /status : description du bâti actuel chargé
+    - POST /compare : comparaison avec un cadastre, paramètres
+        {"buildings": fichier du cadastre, "prefix": préfixe des fichiers
+        résultats, "borne_inf": ..., "borne_sup": ..., "stats_only": ...,
+        "split_count": ..., "split_tile": ..., "spatial_order": ...,
+        "dense_density": ...}.
+        La réponse est le résumé retourné par compare.
+    - POST /reload : relecture du bâti actuel, éventuellement depuis
+        {"source": autre fichier ou base}
+
+    Les requêtes sont traitées l'une après l'autre : le bâti actuel est
+    modifié par chaque comparaison.
+    """
+
+    def send_json(self, code: int, content: dict):
+        body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        self.send_json(200, self.server.current.status())
+
+    @staticmethod
+    def compare_options(request: dict) -> dict:
+        """Options de compare lues dans une requête /compare, vérifiées comme
+        celles de la ligne de commande (ValueError sinon)."""
+        for name in ("stats_only", "dense_density"):
+            if not isinstance(request.get(name, False), bool):
+                raise ValueError(f"{name} must be true or false")
+        split_count = request.get("split_count")
+        split_tile = request.get("split_tile")
+        if split_count is not None and (isinstance(split_count, bool) or not isinstance(split_count, int)
+                                        or split_count <= 0):
+            raise ValueError("split_count must be a positive integer")
+        if split_tile is not None and (isinstance(split_tile, bool) or not isinstance(split_tile, (int, float))
+                                       or split_tile <= 0):
+            raise ValueError("split_tile must be a positive number")
+        if split_count is not None and split_tile is not None:
+            raise ValueError("split_count and split_tile are mutually exclusive")
+        spatial_order = request.get("spatial_order", "none")
+        if spatial_order not in ("none", "hilbert", "zorder"):
+            raise ValueError("spatial_order must be none, hilbert or zorder")
+        return {
+            "stats_only": request.get("stats_only", False),
+            "split_count": split_count,
+            "split_tile": split_tile,
+            "spatial_order": spatial_order,
+            "dense_density": request.get("dense_density", False),
+            "borne_inf": float(request.get("borne_inf", BORNE_INF_MODIF)),
+            "borne_sup": float(request.get("borne_sup", BORNE_SUP_MODIF)),
+        }
+
+    def do_POST(self):
+        log = logging.getLogger("serve")
+        current = self.server.current
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/compare":
+                options = self.compare_options(request)
+                log.info(f"comparaison avec {request['buildings']}...")
+                summary = compare(
+                    current.source, request["buildings"], request["prefix"], os.getcwd(),
+                    store=current.store, skip_unused_nodes=current.skip_unused_nodes, jobs=self.server.jobs,
+                    current=current, **options)
+                self.send_json(200, summary)
+            elif self.path == "/reload":
+                current.load(request.get("source"))
+                self.send_json(200, current.status())
+            else:
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+        except KeyError as e:
+            self.send_json(400, {"error": f"missing parameter {e}"})
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            log.exception(e)
+            self.send_json(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        logging.getLogger("serve").debug(format % args)
+
+
+def serve_main(argv: list):
+    """Serveur : le bâti actuel est chargé une seule fois, puis comparé aux
+    cadastres envoyés en HTTP (voir ServeHandler)."""
+    parser = argparse.ArgumentParser(
+        prog="BatiOsm serve",
+        description="Load the current buildings once and run the comparisons requested over HTTP"
+                    " (POST /compare, POST /reload, GET /status)")
+    parser.add_argument("source", help="OSM source file (or SQLite database with --store)", type=str)
+    parser.add_argument("--store", help="Read the current buildings from the database built by 'ingest'",
+                        action='store_true')
+    parser.add_argument("--skip-unused-nodes",
+                        help="Only read building ways and relations, and the nodes they use",
+                        action='store_true')
+    parser.add_argument("--port", help=f"Port to listen to on localhost (default: {SERVE_PORT})",
+                        type=int, default=SERVE_PORT)
+    parser.add_argument("--socket", help="Listen to this Unix socket instead of a TCP port", type=str)
+    parser.add_argument("--jobs", help="Number of processes used to write the result files (default: 1)",
+                        type=int, default=1)
+    parser.add_argument("--debug", help="Enable debug", action='store_true')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.debug)
+    log = logging.getLogger("serve")
+    current = CurrentBuildings(args.source, args.store, args.skip_unused_nodes)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, ServeHandler)
+        log.info(f"en attente des comparaisons sur {args.socket}")
+    else:
+        server = http.server.HTTPServer(("127.0.0.1", args.port), ServeHandler)
+        log.info(f"en attente des comparaisons sur http://127.0.0.1:{args.port}")
+    server.current = current
+    server.jobs = args.jobs
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.remove(args.socket)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "ingest":
+        ingest_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        prog="BatiOsm",
+        description="Analyze two OSM files and prepare files to simplify imports and updates",
+        epilog="Use 'BatiOsm ingest store.sqlite file.osm...' to build a database usable with --store,"
+               " and 'BatiOsm serve source' to keep the current buildings loaded between comparisons")
+    parser.add_argument("source", help="OSM source file (or SQLite database with --store)", type=str)
+    parser.add_argument("buildings", help="File with Buildings, in general a cadastre export", type=str)
+    parser.add_argument("prefix", help="Prefix for generated files", type=str)
+    parser.add_argument("--store", help="Read the current buildings from the database built by 'ingest'",
+                        action='store_true')
+    parser.add_argument("--skip-unused-nodes",
+                        help="Only read building ways and relations, and the nodes they use",
+                        action='store_true')
+    parser.add_argument("--stats-only",
+                        help="Only write the comparison counts and timings to {prefix}_stats.json",
+                        action='store_true')
+    parser.add_argument("--jobs", help="Number of processes used to write the result files (default: 1)",
+                        type=int, default=1)
+    split = parser.add_mutually_exclusive_group()
+    split.add_argument("--split-count", help="Split each result file into files of at most this many buildings",
+                       type=int)
+    split.add_argument("--split-tile", help="Split each result file into square tiles of this size (degrees)",
+                       type=float)
+    parser.add_argument("--spatial-order",
+                        help="Order the buildings of each result file along a space-filling curve of their centre",
+                        choices=["none", "hilbert", "zorder"], default="none")
+    parser.add_argument("--dense-density",
+                        help="Also write the full NB_ZONE x NB_ZONE density matrices at the end of the log",
+                        action='store_true')
+    parser.add_argument("--memory-limit",
+                        help="Process the grid by strips of zones, keeping about this much memory (MB) of buildings;"
+                             " the input files are indexed in temporary SQLite databases",
+                        type=float)
+    parser.add_argument("--debug", help="Enable debug", action='store_true')
+
+    args = parser.parse_args()
+    if args.split_count is not None and args.split_count <= 0:
+        parser.error("--split-count must be positive")
+    if args.split_tile is not None and args.split_tile <= 0:
+        parser.error("--split-tile must be positive")
+
+    setup_logging(args.debug)
+
+    log = logging.getLogger("main")
+    log.info("Start")
+
+    compare(args.source, args.buildings, args.prefix, os.getcwd(),
+            store=args.store, skip_unused_nodes=args.skip_unused_nodes, stats_only=args.stats_only,
+            jobs=args.jobs, memory_limit=args.memory_limit, debug=args.debug,
+            split_count=args.split_count, split_tile=args.split_tile, spatial_order=args.spatial_order,
+            dense_density=args.dense_density)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,335 @@
+# -*- coding:Utf-8 -*-
+# !/usr/bin/env python
+"""Tests de non-régression et de performance de BatiOsm.
+
+Chaque cas (checks/check1, checks/check2 avec ses multipolygones,
+Exemple/Buzy et un cas plus gros généré en recopiant check1 sur une grille
+de scale x scale) est rejoué dans plusieurs modes (séquentiel, --jobs,
+--memory-limit, --store, --skip-unused-nodes) :
+ - les fichiers de check1 et check2 doivent être identiques aux fichiers de
+   référence checks/checkN_result_* (aux lignes "Temps" du log près, comme
+   test.bat),
+ - pour chaque cas, les fichiers des autres modes doivent contenir les
+   mêmes lignes que ceux du mode séquentiel.
+Le mode jobs signale (REMARQUE) les cas dont l'export est resté séquentiel
+(un seul processeur, ou trop peu de batiments) : l'export parallèle n'y a
+pas été vérifié.
+Les temps de chaque étape (lus dans prefix_log.txt) et la mémoire maximale
+de chaque exécution sont comparés à une référence enregistrée dans
+regression_baseline.json : le test échoue si l'un d'eux dépasse la
+référence de plus de --threshold.
+
+    python checks/regression.py [--update-baseline] [--threshold 0.25]
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import lxml.etree
+
+CHECKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(CHECKS_DIR)
+SCRIPT = os.path.join(ROOT_DIR, "BatiOsm.py")
+BASELINE = os.path.join(CHECKS_DIR, "regression_baseline.json")
+PREFIX = "check1_ci"
+
+# modes rejoués : nom -> options de la ligne de commande
+MODES = {
+    "sequential": [],
+    "jobs": ["--jobs", "2"],
+    "memory": ["--memory-limit", "0.5"],
+    "store": ["--store"],
+    "skip": ["--skip-unused-nodes"],
+}
+# lignes de temps du log : étape -> début de la ligne
+LOG_TIMES = {
+    "read": "Temps de lecture des fichiers : ",
+    "compute": "Temps de calcul : ",
+    "export": "Temps d'export : ",
+    "total": "Temps d'execution totale : ",
+}
+
+
+def generate_case(work_dir: str, scale: int):
+    """Crée un cas plus gros en recopiant check1 scale x scale fois, décalé
+    d'un pas supérieur à l'emprise de check1. Les identifiants sont décalés
+    à chaque copie pour rester uniques. Les fichiers sont lus et écrits au fil
+    de l'eau : la mémoire maximale de ce processus est héritée par les
+    exécutions mesurées et doit rester faible."""
+    files = []
+    for name in ("check1_as_in.osm", "check1_cadastre.osm"):
+        file_name = os.path.join(work_dir, f"generated{scale}x{scale}_{name}")
+        with lxml.etree.xmlfile(file_name, encoding="UTF-8") as result:
+            result.write_declaration()
+            with result.element("osm", version="0.6", generator="regression.py"):
+                for i_copy in range(scale * scale):
+                    d_lat = (i_copy // scale) * 0.01
+                    d_lon = (i_copy % scale) * 0.05
+                    offset = i_copy * 10 ** 10
+                    for _, element in lxml.etree.iterparse(os.path.join(CHECKS_DIR, name),
+                                                           tag=("node", "way", "relation")):
+                        element.set("id", str(shift_id(element.get("id"), offset)))
+                        if element.tag == "node":
+                            element.set("lat", str(round(float(element.get("lat")) + d_lat, 7)))
+                            element.set("lon", str(round(float(element.get("lon")) + d_lon, 7)))
+                        for child in element:
+                            if child.get("ref") is not None:
+                                child.set("ref", str(shift_id(child.get("ref"), offset)))
+                        result.write(element)
+                        element.clear()
+        files.append(file_name)
+    return files
+
+
+def shift_id(osm_id: str, offset: int) -> int:
+    """Décale un identifiant en conservant son signe (les objets du
+    cadastre ont des identifiants négatifs)."""
+    osm_id = int(osm_id)
+    return osm_id - offset if osm_id < 0 else osm_id + offset
+
+
+def run(arguments: list, cwd: str):
+    """Exécute BatiOsm dans cwd. Retourne la durée et la mémoire maximale
+    (en Mo) du processus et de ses processus fils."""
+    tps = time.perf_counter()
+    with open(os.path.join(cwd, "run.out"), "a") as output:
+        process = subprocess.Popen([sys.executable, SCRIPT] + arguments, cwd=cwd,
+                                   stdout=output, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    duration = time.perf_counter() - tps
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"BatiOsm {' '.join(arguments)} a échoué, voir {cwd}/run.out")
+    # ru_maxrss est en kilo-octets sous Linux et en octets sous macOS
+    peak_memory = usage.ru_maxrss / 1024 if sys.platform != "darwin" else usage.ru_maxrss / 1024 / 1024
+    return duration, peak_memory
+
+
+def read_log_times(log_file_name: str) -> dict:
+    times = {}
+    with open(log_file_name) as log_file:
+        for line in log_file:
+            for stage, start in LOG_TIMES.items():
+                if line.startswith(start):
+                    times[stage] = float(line[len(start):].split()[0])
+    return times
+
+
+def normalized_log(log_file_name: str, prefix: str, replacements: dict) -> list:
+    """Lignes du log sans les temps ni les noms des fichiers résultats, avec
+    les chemins des fichiers d'entrée remplacés (comme test.bat)."""
+    lines = []
+    with open(log_file_name) as log_file:
+        for line in log_file:
+            if line.startswith("Temps"):
+                continue
+            line = re.sub(f"{prefix}_.*\\.osm", "REPLACEME", line)
+            for path, replacement in replacements.items():
+                line = line.replace(path, replacement)
+            lines.append(line.rstrip())
+    return lines
+
+
+def export_notes(run_output: str) -> list:
+    """Signale un mode jobs dont l'export est resté séquentiel : ses
+    fichiers sont alors identiques à ceux du mode sequential sans que
+    l'export parallèle ait été vérifié."""
+    with open(run_output) as output:
+        lines = output.read().splitlines()
+    if any("export parallèle" in line for line in lines):
+        return []
+    warnings = [line for line in lines if "--jobs est sans effet" in line]
+    if warnings:
+        return [f"export séquentiel ({warnings[0].split('--jobs est sans effet : ')[-1]})"]
+    return ["export séquentiel (trop peu de batiments par écriture)"]
+
+
+def compare_outputs(reference_dir: str, reference_prefix: str, result_dir: str, result_prefix: str,
+                    ordered: bool) -> list:
+    """Compare les fichiers osm de deux exécutions. Retourne la liste des
+    différences."""
+    errors = []
+    reference_files = sorted(name[len(reference_prefix):] for name in os.listdir(reference_dir)
+                             if name.startswith(reference_prefix) and name.endswith(".osm"))
+    result_files = sorted(name[len(result_prefix):] for name in os.listdir(result_dir)
+                          if name.startswith(result_prefix) and name.endswith(".osm"))
+    if reference_files != result_files:
+        return [f"fichiers différents : {reference_files} / {result_files}"]
+    for name in reference_files:
+        with open(os.path.join(reference_dir, reference_prefix + name)) as reference:
+            expected = reference.read()
+        with open(os.path.join(result_dir, result_prefix + name)) as result:
+            actual = result.read()
+        if not ordered:
+            expected = sorted(expected.split("\n"))
+            actual = sorted(actual.split("\n"))
+        if expected != actual:
+            errors.append(f"{result_prefix}{name} différent de {reference_prefix}{name}")
+    return errors
+
+
+def run_case(name: str, as_is: str, cadastre: str, work_dir: str, modes: list, golden: str) -> dict:
+    """Rejoue un cas dans chacun des modes. golden est le nom des fichiers de
+    référence du cas (None s'il n'en a pas). Retourne, pour chaque mode, les
+    temps, la mémoire maximale et les erreurs constatées."""
+    case_dir = os.path.join(work_dir, name)
+    os.makedirs(case_dir)
+    results = {}
+    for mode in modes:
+        mode_dir = os.path.join(case_dir, mode)
+        os.makedirs(mode_dir)
+        times = {}
+        source = as_is
+        peak_memory = 0.0
+        if mode == "store":
+            source = os.path.join(mode_dir, "as_is.sqlite")
+            times["ingest"], peak_memory = run(["ingest", source, as_is], mode_dir)
+        duration, run_memory = run([source, cadastre, PREFIX] + MODES[mode], mode_dir)
+        times.update(read_log_times(os.path.join(mode_dir, f"{PREFIX}_log.txt")))
+        times["wall"] = duration
+        errors = []
+        notes = export_notes(os.path.join(mode_dir, "run.out")) if mode == "jobs" else []
+        if golden and mode == "sequential":
+            errors = compare_outputs(CHECKS_DIR, f"{golden}_result_", mode_dir, f"{PREFIX}_", True)
+            expected = normalized_log(os.path.join(CHECKS_DIR, f"{golden}_result_log.txt"), PREFIX, {})
+            if normalized_log(os.path.join(mode_dir, f"{PREFIX}_log.txt"), PREFIX,
+                              {CHECKS_DIR + "/": ""}) != expected:
+                errors.append(f"log différent de {golden}_result_log.txt")
+        elif mode != "sequential":
+            reference_dir = os.path.join(case_dir, "sequential")
+            # seuls l'export parallèle et --skip-unused-nodes (même lecture des
+            # batiments) garantissent le même ordre des batiments
+            errors = compare_outputs(reference_dir, f"{PREFIX}_", mode_dir, f"{PREFIX}_", mode in ("jobs", "skip"))
+            expected = normalized_log(os.path.join(reference_dir, f"{PREFIX}_log.txt"), PREFIX, {as_is: "INPUT"})
+            result = normalized_log(os.path.join(mode_dir, f"{PREFIX}_log.txt"), PREFIX, {source: "INPUT"})
+            if mode in ("store", "skip"):
+                # les noeuds hors batiments ne sont pas lus : seuls les
+                # comptages de noeuds diffèrent
+                expected = [line for line in expected if "noeuds" not in line]
+                result = [line for line in result if "noeuds" not in line]
+            if sorted(result) != sorted(expected):
+                errors.append("log différent de celui du mode sequential")
+        results[mode] = {"times": times, "peak_memory": max(peak_memory, run_memory), "errors": errors,
+                         "notes": notes}
+    return results
+
+
+def check_regressions(key: str, measure: dict, reference: dict, threshold: float,
+                      min_seconds: float, min_memory: float) -> list:
+    """Compare une mesure à sa référence : un temps ou la mémoire maximale
+    régresse s'il dépasse la référence de plus de threshold (en proportion)
+    et d'au moins min_seconds (resp. min_memory Mo)."""
+    regressions = []
+    for stage, value in measure["times"].items():
+        previous = reference.get("times", {}).get(stage)
+        if previous is not None and value > previous * (1 + threshold) and value - previous > min_seconds:
+            regressions.append(f"{key} : temps {stage} {value:.3f} s au lieu de {previous:.3f} s")
+    previous = reference.get("peak_memory")
+    value = measure["peak_memory"]
+    if previous is not None and value > previous * (1 + threshold) and value - previous > min_memory:
+        regressions.append(f"{key} : mémoire {value:.1f} Mo au lieu de {previous:.1f} Mo")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay the checks and examples, check the outputs and compare timings and peak memory"
+                    " with a stored baseline")
+    parser.add_argument("--baseline", help=f"Baseline file (default: {BASELINE})", default=BASELINE)
+    parser.add_argument("--update-baseline", help="Store the measures as the new baseline", action="store_true")
+    parser.add_argument("--threshold", help="Allowed relative slowdown or memory growth (default: 0.25)",
+                        type=float, default=0.25)
+    parser.add_argument("--min-seconds", help="Ignore time regressions smaller than this (default: 0.05)",
+                        type=float, default=0.05)
+    parser.add_argument("--min-memory", help="Ignore memory regressions smaller than this, in MB (default: 5)",
+                        type=float, default=5.0)
+    parser.add_argument("--scale", help="Size of the generated case, in copies of check1 per side"
+                                        " (default: 3, 0 to skip it)", type=int, default=3)
+    parser.add_argument("--repeat", help="Run each case this many times and keep the best measures (default: 1)",
+                        type=int, default=1)
+    parser.add_argument("--modes", help="Modes to replay (default: all)", nargs="+",
+                        choices=list(MODES), default=list(MODES))
+    parser.add_argument("--keep", help="Keep the work directory", action="store_true")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="BatiOsm_regression_")
+    cases = [
+        ("check1", os.path.join(CHECKS_DIR, "check1_as_in.osm"), os.path.join(CHECKS_DIR, "check1_cadastre.osm"),
+         "check1"),
+        ("check2", os.path.join(CHECKS_DIR, "check2_as_in.osm"), os.path.join(CHECKS_DIR, "check2_cadastre.osm"),
+         "check2"),
+        ("buzy", os.path.join(ROOT_DIR, "Exemple", "Buzy_as_is.osm"), os.path.join(ROOT_DIR, "Exemple", "Buzy_to_be.osm"),
+         None),
+    ]
+    if args.scale > 0:
+        as_is, cadastre = generate_case(work_dir, args.scale)
+        cases.append((f"generated{args.scale}x{args.scale}", as_is, cadastre, None))
+    modes = ["sequential"] + [mode for mode in args.modes if mode != "sequential"]
+
+    measures = {}
+    errors = []
+    notes = []
+    try:
+        for name, as_is, cadastre, golden in cases:
+            for i_repeat in range(args.repeat):
+                results = run_case(f"{name}_{i_repeat}", as_is, cadastre, work_dir, modes, golden)
+                for mode, result in results.items():
+                    key = f"{name}/{mode}"
+                    errors.extend(f"{key} : {error}" for error in result["errors"])
+                    notes.extend(f"{key} : {note}" for note in result["notes"] if i_repeat == 0)
+                    if key not in measures:
+                        measures[key] = {"times": result["times"], "peak_memory": result["peak_memory"]}
+                        continue
+                    best = measures[key]
+                    for stage, value in result["times"].items():
+                        best["times"][stage] = min(best["times"].get(stage, value), value)
+                    best["peak_memory"] = min(best["peak_memory"], result["peak_memory"])
+    finally:
+        if args.keep:
+            print(f"répertoire de travail : {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regressions = []
+    print(f"{'cas / mode':32} {'lecture':>9} {'calcul':>9} {'export':>9} {'total':>9} {'mémoire':>9}")
+    for key, measure in measures.items():
+        times = measure["times"]
+        print(f"{key:32} {times.get('read', 0):9.3f} {times.get('compute', 0):9.3f} {times.get('export', 0):9.3f}"
+              f" {times.get('total', 0):9.3f} {measure['peak_memory']:7.1f}Mo")
+        if key in baseline:
+            regressions.extend(check_regressions(key, measure, baseline[key], args.threshold,
+                                                 args.min_seconds, args.min_memory))
+
+    for note in notes:
+        print(f"REMARQUE {note}")
+    for error in errors:
+        print(f"ERREUR {error}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not baseline:
+        print(f"pas de référence dans {args.baseline} : utiliser --update-baseline pour l'enregistrer")
+
+    if args.update_baseline:
+        if errors:
+            print("référence non mise à jour : les résultats sont faux")
+        else:
+            with open(args.baseline, "w") as baseline_file:
+                json.dump(measures, baseline_file, indent=2)
+                baseline_file.write("\n")
+            print(f"référence enregistrée dans {args.baseline}")
+    if errors or (regressions and not args.update_baseline):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
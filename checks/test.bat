@@ -36,5 +36,15 @@ trap cleanup EXIT
     diff "${DIR}/check1_result_sup_1_a_15.osm"  "${PREFIX}_sup_1_a_15.osm" -u0
     diff "${DIR}/check1_result_unModified.osm"  "${PREFIX}_unModified.osm" -u0
 
+    echo "Checks step 4: run the multipolygon case, with and without --skip-unused-nodes"
+    for OPTION in "" "--skip-unused-nodes"; do
+        rm -f "${PREFIX}"_*
+        python "${DIR}/../BatiOsm.py" "${DIR}/check2_as_in.osm" "${DIR}/check2_cadastre.osm" "$PREFIX" $OPTION
+        diff "${DIR}/check2_result_mod_1_a_1.osm"    "${PREFIX}_mod_1_a_1.osm" -u0
+        diff "${DIR}/check2_result_new_1_a_1.osm"    "${PREFIX}_new_1_a_1.osm" -u0
+        diff "${DIR}/check2_result_sup_1_a_1.osm"    "${PREFIX}_sup_1_a_1.osm" -u0
+        diff "${DIR}/check2_result_unModified.osm"   "${PREFIX}_unModified.osm" -u0
+    done
+
     echo "Checks are done"
 }
\ No newline at end of file